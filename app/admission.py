@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Admission control in front of synthesis.
+
+ユーザーごと・サーバーごとのトークンバケット(文字数で重み付け)で連投を弾き、
+同じ文面の繰り返しはまとめて1回にする。
+"""
+import time
+from collections import Counter
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, cost: float) -> bool:
+        # 上限より重いメッセージも満タンなら通し、その分は借りにする
+        return self.tokens >= min(cost, self.capacity)
+
+    def take(self, cost: float, now: float) -> bool:
+        self.refill(now)
+        if not self.ready(cost):
+            return False
+        self.tokens -= cost
+        return True
+
+
+class AdmissionControl:
+    """Per-user and per-guild rate limits plus duplicate collapsing"""
+
+    def __init__(self, user_rate: float, user_burst: float, guild_rate: float, guild_burst: float,
+                 repeat_window: float = 10.0, chars_per_token: int = 50, notice_interval: float = 60.0):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.repeat_window = repeat_window
+        self.chars_per_token = chars_per_token
+        self.notice_interval = notice_interval
+        self.admitted = 0
+        self.rejected: Counter[str] = Counter()
+        self._users: dict[tuple[int, int], TokenBucket] = dict()
+        self._guilds: dict[int, TokenBucket] = dict()
+        self._recent: dict[tuple[int, str], float] = dict()
+        self._notices: dict[int, float] = dict()
+        self._checks = 0
+
+    def cost(self, text: str) -> float:
+        # 長いメッセージほど合成が重いので多く消費する
+        return 1 + len(text) / self.chars_per_token
+
+    def admit(self, guild_id: int, user_id: int, text: str) -> str | None:
+        """Return None if the message may be read, otherwise the reason it was rejected"""
+        now = time.monotonic()
+        self._checks += 1
+        if self._checks % 1000 == 0:
+            self._prune(now)
+
+        if self.repeat_window:
+            last = self._recent.get((guild_id, text))
+            if last is not None and now - last < self.repeat_window:
+                return self._reject('repeat')
+
+        cost = self.cost(text)
+        if self.user_rate:
+            bucket = self._users.get((guild_id, user_id))
+            if bucket is None:
+                bucket = self._users[(guild_id, user_id)] = TokenBucket(self.user_rate, self.user_burst, now)
+            bucket.refill(now)
+            if not bucket.ready(cost):
+                return self._reject('user')
+        if self.guild_rate:
+            guild_bucket = self._guilds.get(guild_id)
+            if guild_bucket is None:
+                guild_bucket = self._guilds[guild_id] = TokenBucket(self.guild_rate, self.guild_burst, now)
+            if not guild_bucket.take(cost, now):
+                return self._reject('guild')
+        if self.user_rate:
+            bucket.tokens -= cost
+        if self.repeat_window:
+            self._recent[(guild_id, text)] = now
+        self.admitted += 1
+        return None
+
+    def should_notify(self, guild_id: int) -> bool:
+        """Rate-limit rejection notices to one per guild per notice_interval"""
+        now = time.monotonic()
+        if now - self._notices.get(guild_id, float('-inf')) < self.notice_interval:
+            return False
+        self._notices[guild_id] = now
+        return True
+
+    def _reject(self, reason: str) -> str:
+        self.rejected[reason] += 1
+        return reason
+
+    def _prune(self, now: float):
+        # 満タンに戻ったバケツと古い記録は捨ててメモリを増やさない
+        for key, bucket in list(self._users.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._users[key]
+        for key, bucket in list(self._guilds.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._guilds[key]
+        for key, last in list(self._recent.items()):
+            if now - last >= self.repeat_window:
+                del self._recent[key]
+        for key, last in list(self._notices.items()):
+            if now - last >= self.notice_interval:
+                del self._notices[key]
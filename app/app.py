@@ -2,16 +2,29 @@
 import discord
 from discord.ext import commands
 import os
+import random
 import re
-import subprocess
 import time
 from threading import Timer
-from collections import defaultdict, deque
 import asyncio
-import uuid
 import atexit
 import signal
 import threading
+import dataclasses
+
+import metrics
+import tracing
+from admission import AdmissionControl
+from audio import ClipStream, OpusBufferSource, PCMBufferSource, make_clip
+from dictionary import HEADER as DICT_HEADER, DictionaryStore, parse_entries, render_messages
+from loop_monitor import LoopMonitor
+from names import NameCache, NameResolver
+from pipeline import BacklogPolicy, SpeechPipeline
+from scheduler import SynthesisScheduler, Ticket
+from session import GuildSession, SessionRegistry
+from speech_cache import AudioCache
+from tts import SynthesisEngine, VoiceParams
+from tts_service import RemoteSynthesisEngine
 
 # from dotenv import load_dotenv
 # load_dotenv()
@@ -27,7 +40,8 @@ else:
     except Exception as e:
         print(f"Failed to load opus: {e}")
 
-queue_dict = defaultdict(deque)
+# サーバーごとの読み上げセッション
+sessions = SessionRegistry()
 connecting_channels = set()
 active_processes = set()
 cleanup_lock = threading.Lock()
@@ -43,72 +57,269 @@ try:
 except ValueError as e:
     raise ValueError(f"DICT_CH_ID must be a valid integer: {os.environ['DICT_CH_ID']}") from e
 
-dictMsg = None
+# シャード構成。SHARD_COUNT だけなら1プロセスで全シャード、SHARD_IDS も指定すると
+# そのシャードだけを受け持つ(launcher.py が複数のプロセスに割り振る)
+SHARD_COUNT = os.environ.get('SHARD_COUNT', '')
+SHARD_IDS = [int(shard_id) for shard_id in os.environ.get('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+if SHARD_IDS and not SHARD_COUNT.isdigit():
+    raise EnvironmentError("SHARD_IDS requires SHARD_COUNT to be the total number of shards")
+# 他のプロセスと辞書や音声キャッシュを共有しているか
+SHARED_PROCESS = SHARD_IDS is not None
+# 他のプロセスが辞書を変更していないか確認する間隔(秒)
+DICT_REFRESH_INTERVAL = float(os.environ.get('DICT_REFRESH_INTERVAL', '5'))
+
+# 辞書の正本はローカルに置き、辞書チャンネルへはまとめて書き戻す
+dict_store = DictionaryStore(os.environ.get('DICT_DB_PATH', 'dictionary.sqlite3'))
+# 辞書チャンネルにある辞書のメッセージ(古い順)。None なら未読み込み
+dict_messages: list[discord.Message] | None = None
+dict_written_version = 0
+dict_write_task: asyncio.Task | None = None
+# 終了するときに書き戻しの待ちを飛ばす
+dict_flushing = asyncio.Event()
+# 変更をまとめて書き戻すまでの待ち時間(秒)
+DICT_WRITE_DELAY = float(os.environ.get('DICT_WRITE_DELAY', '10'))
+
+# OpenJTalk 1回あたりの合成タイムアウト(秒)
+JTALK_TIMEOUT = float(os.environ.get('JTALK_TIMEOUT', '30'))
+# 文ごとに分けて合成し、最初の文ができた時点で読み上げを始める
+TTS_STREAMING = os.environ.get('TTS_STREAMING', '1') != '0'
+# 読み上げる最大文字数(分割して合成するときは長めにできる)
+MAX_TEXT_LENGTH = int(os.environ.get('MAX_TEXT_LENGTH', '400' if TTS_STREAMING else '150'))
+# 読点で区切り始める長さ
+SEGMENT_LENGTH = int(os.environ.get('SEGMENT_LENGTH', '40'))
+# 再生中のクリップの先に合成しておく数
+TTS_LOOKAHEAD = int(os.environ.get('TTS_LOOKAHEAD', '2'))
+# 読み上げが溜まったときの追いつき方(0 なら無効)
+BACKLOG_POLICY = BacklogPolicy(
+    max_depth=int(os.environ.get('BACKLOG_MAX_DEPTH', '30')),
+    max_age=float(os.environ.get('BACKLOG_MAX_AGE', '60')),
+    coalesce_length=int(os.environ.get('BACKLOG_COALESCE_LENGTH', '15')),
+    coalesce_max=int(os.environ.get('BACKLOG_COALESCE_MAX', '60')),
+    coalesce_backlog=int(os.environ.get('BACKLOG_COALESCE_AT', '3')),
+    speedup_backlog=int(os.environ.get('BACKLOG_SPEEDUP_AT', '5')),
+    speedup=float(os.environ.get('BACKLOG_SPEEDUP', '1.3')),
+)
+# 常駐合成ワーカー数(デフォルトはコア数)
+TTS_WORKERS = int(os.environ.get('TTS_WORKERS', '0')) or os.cpu_count() or 1
+
+# 連投対策。ユーザーごと・サーバーごとに1秒あたりに補充するトークン数と上限(0 なら無効)
+# 1メッセージで 1 + 文字数/50 トークン使う
+admission = AdmissionControl(
+    user_rate=float(os.environ.get('ADMISSION_USER_RATE', '0.5')),
+    user_burst=float(os.environ.get('ADMISSION_USER_BURST', '5')),
+    guild_rate=float(os.environ.get('ADMISSION_GUILD_RATE', '2')),
+    guild_burst=float(os.environ.get('ADMISSION_GUILD_BURST', '20')),
+    # 同じ文面がこの秒数以内に繰り返されたら読まない
+    repeat_window=float(os.environ.get('ADMISSION_REPEAT_WINDOW', '10')),
+    # 読み上げなかったことをチャンネルに知らせる間隔(秒)
+    notice_interval=float(os.environ.get('ADMISSION_NOTICE_INTERVAL', '60')),
+)
+# 同時に合成する数の上限。空きはサーバーごとに公平に回し、挨拶と短いメッセージを先にする
+synthesis_scheduler = SynthesisScheduler(
+    int(os.environ.get('SYNTH_CONCURRENCY', '0')) or TTS_WORKERS,
+    int(os.environ.get('SYNTH_SHORT_LENGTH', '20')),
+)
+
+DEFAULT_VOICE = VoiceParams()
+# /volume で変えられる音量の範囲(1.0 が揃えた音量のまま)
+MIN_VOLUME = 0.1
+MAX_VOLUME = 2.0
+# 参加・退出の読み上げ。参加時などに前もって合成してキャッシュに入れておく
+GREETING_JOIN = '{}さんこんにちは！'
+GREETING_LEAVE = '{}さんが退出しました'
+# 合成サーバー(tts_service.py)のアドレス。指定するとこのプロセスでは合成しない
+TTS_SERVER = os.environ.get('TTS_SERVER', '')
+if TTS_SERVER:
+    synthesis_engine = RemoteSynthesisEngine(
+        TTS_SERVER, int(os.environ.get('TTS_SERVER_CONNECTIONS', '4')), JTALK_TIMEOUT)
+else:
+    synthesis_engine = SynthesisEngine(TTS_WORKERS, JTALK_TIMEOUT, active_processes, cleanup_lock)
+
+# 合成済み音声のキャッシュ(ディスク側は TTS_CACHE_DIR を指定したときだけ使う)
+audio_cache = AudioCache(
+    int(os.environ.get('TTS_CACHE_BYTES', str(64 * 1024 * 1024))),
+    os.environ.get('TTS_CACHE_DIR') or None,
+    int(os.environ.get('TTS_CACHE_DISK_BYTES', str(512 * 1024 * 1024))),
+    shared=SHARED_PROCESS,
+)
+rendering: dict[str, '_Rendering'] = dict()
+# 合成したら一度だけ Opus にエンコードしてキャッシュし、再生中はエンコードしない
+OPUS_PASSTHROUGH = discord.opus.is_loaded() and os.environ.get('TTS_OPUS', '1') != '0'
+OPUS_BITRATE = int(os.environ.get('TTS_OPUS_BITRATE', '64'))
+CLIP_ENCODING = f'opus{OPUS_BITRATE}' if OPUS_PASSTHROUGH else 'pcm'
+# 読み上げるものが無くなってから再生を止めるまで、次のクリップを待つ時間(秒)
+PLAYBACK_LINGER_FRAMES = round(float(os.environ.get('PLAYBACK_LINGER', '0.2')) / 0.02)
+# ボイスの接続が切れたときに待ちを残したままつなぎ直す回数(0 なら読み上げを終える)と、
+# 試す間隔の上限(秒)
+VOICE_RECONNECT_ATTEMPTS = int(os.environ.get('VOICE_RECONNECT_ATTEMPTS', '5'))
+VOICE_RECONNECT_BACKOFF = float(os.environ.get('VOICE_RECONNECT_BACKOFF', '30'))
+
+# メトリクス(METRICS_PORT を指定すると http://METRICS_HOST:METRICS_PORT/metrics で公開する)
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+registry = metrics.Registry()
+message_latency = registry.histogram(
+    'tts_message_latency_seconds', 'Time from receiving a message to its first audio frame')
+synthesis_time = registry.histogram('tts_synthesis_seconds', 'Time spent synthesizing one clip on a cache miss')
+queue_wait = registry.histogram('tts_queue_wait_seconds', 'Time a cache miss waited for a synthesis slot')
+playback_gap = registry.histogram(
+    'tts_playback_gap_seconds', 'Silence between consecutive clips that were already queued')
+errors = registry.counter('tts_errors_total', 'Errors by stage', ('stage',))
+voice_reconnects = registry.counter('tts_voice_reconnects_total', 'Voice connection attempts after the first')
+voice_reconnect_time = registry.histogram(
+    'tts_voice_reconnect_seconds', 'Time from losing the voice connection to having it back',
+    (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+registry.gauge_func(
+    'tts_queue_depth', 'Messages waiting to be read per guild',
+    lambda: {(str(session.guild_id),): len(session.pipeline) for session in sessions}, ('guild',))
+registry.gauge_func('tts_voice_sessions', 'Guilds with an active reading session', lambda: len(sessions))
+registry.gauge_func('tts_synthesis_processes', 'Running open_jtalk and synthesis worker processes',
+                    lambda: len(active_processes))
+registry.gauge_func('tts_synthesis_in_flight', 'Clips being synthesized', lambda: synthesis_scheduler.in_use)
+registry.gauge_func('tts_synthesis_queued', 'Clips waiting for a synthesis slot', lambda: len(synthesis_scheduler))
+registry.gauge_func('tts_cache_entries', 'Clips in the memory cache', lambda: len(audio_cache))
+registry.gauge_func(
+    'tts_cache_bytes', 'Bytes held by the audio cache',
+    lambda: {('memory',): audio_cache.memory_bytes, ('disk',): audio_cache.disk_bytes}, ('tier',))
+registry.counter_func(
+    'tts_cache_lookups_total', 'Audio cache lookups by result',
+    lambda: {('hit',): audio_cache.hits, ('disk_hit',): audio_cache.disk_hits, ('miss',): audio_cache.misses},
+    ('result',))
+
+
+def dropped_totals() -> dict:
+    backlog = sessions.backlog_totals()
+    totals = {('backlog',): backlog.dropped, ('stale',): backlog.stale, ('deadline',): synthesis_scheduler.expired}
+    totals.update(((f'admission_{reason}',), count) for reason, count in admission.rejected.items())
+    return totals
+
+
+registry.counter_func('tts_dropped_total', 'Messages not read, by reason', dropped_totals, ('reason',))
+registry.counter_func(
+    'tts_synthesis_reconnects_total', 'Synthesis worker restarts or synthesis server reconnects',
+    lambda: getattr(synthesis_engine, 'restarts', 0) + getattr(synthesis_engine, 'reconnects', 0))
+
+# イベントループの遅れの計測と、ループを止めた処理のスタックの出力(/monitor で切り替えられる)
+LOOP_MONITOR = os.environ.get('LOOP_MONITOR', '0') != '0'
+loop_lag = registry.histogram(
+    'tts_loop_lag_seconds', 'How late the event loop ran a timer while the monitor is on',
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+loop_monitor = LoopMonitor(
+    float(os.environ.get('LOOP_MONITOR_INTERVAL', '0.05')),
+    float(os.environ.get('LOOP_SLOW_CALLBACK', '0.1')),
+    loop_lag.observe,
+)
+registry.counter_func('tts_loop_stalls_total', 'Times the event loop was blocked past the threshold',
+                      lambda: loop_monitor.stalls)
+registry.counter_func('tts_offloop_jobs_total', 'Blocking calls run in the default executor',
+                      lambda: loop_monitor.executor.jobs)
+registry.counter_func('tts_offloop_seconds_total', 'Time spent in the default executor',
+                      lambda: loop_monitor.executor.busy_seconds)
+
+# メッセージごとの段階別の時間(TRACE_EXPORT を指定すると JSON Lines でも書き出す)
+tracer = tracing.Tracer(int(os.environ.get('TRACE_BUFFER', '2000')), os.environ.get('TRACE_EXPORT') or None)
 
 userNicknameDict:dict[int,str] = dict ()
 
-def enqueue(voice_client: discord.VoiceClient, guild: discord.Guild, source, filename: str):
-    # ボイスクライアントが存在しない、または接続されていない場合は、キューに追加せずに終了
-    if not voice_client or not voice_client.is_connected():
-        print("Voice client is not available or not connected. Skipping enqueue.")
-        # Clean up the audio file
+def start_session(guild: discord.Guild, text_channel_id: int, voice_client: discord.VoiceClient) -> GuildSession:
+    session = GuildSession(guild.id, text_channel_id, voice_client, None, DEFAULT_VOICE)
+    session.pipeline = SpeechPipeline(
+        lambda text, speed, urgent, deadline: render(
+            text, session_voice(session, speed), Ticket(guild.id, urgent, deadline, session.queue_wait),
+            session.volume),
+        lambda clip: play(session, clip), TTS_LOOKAHEAD, BACKLOG_POLICY, playback_gap.observe)
+    return sessions.add(session)
+
+
+def prerender_greetings(session: GuildSession, members):
+    """Synthesize members' join and leave announcements ahead of time
+
+    Cached per voice, volume and encoding like any clip, so the
+    announcement itself plays without synthesizing.
+    """
+    names = {userNicknameDict.get(member.id, member.display_name) for member in members if not member.bot}
+    texts = [template.format(name) for name in names for template in (GREETING_JOIN, GREETING_LEAVE)]
+    if not texts:
+        return
+    task = asyncio.create_task(prerender(session, texts))
+    session.prerendering.add(task)
+    task.add_done_callback(session.prerendering.discard)
+
+
+async def prerender(session: GuildSession, texts: list[str]):
+    params, gain = session_voice(session), session.volume
+    # 1つずつ、他の合成が無いときに合成する(キャッシュにあれば何もしない)
+    for text in texts:
         try:
-            if os.path.exists(filename):
-                os.remove(filename)
+            await render(text, params, Ticket(session.guild_id, background=True), gain)
         except Exception as e:
-            print(f"Failed to remove audio file {filename}: {e}")
-        return
+            print(f"Failed to prerender {text!r}: {type(e).__name__}: {e}")
 
-    queue = queue_dict[guild.id]
-    queue.append([source, filename])
 
-    if not voice_client.is_playing():
-        play(voice_client, queue)
+def session_voice(session: GuildSession, speed: float = 1.0) -> VoiceParams:
+    if speed == 1.0:
+        return session.voice
+    # 溜まっているときは早口にする
+    return dataclasses.replace(session.voice, speed=round(session.voice.speed * speed, 2))
 
 
-def play(voice_client: discord.VoiceClient, queue: deque):
-    if not queue or voice_client.is_playing():
-        return
+async def play(session: GuildSession, clip: bytes):
+    """Play one clip on the session's voice client and wait until it finishes
 
-    # Check if voice client is still connected
-    if not voice_client.is_connected():
-        print("Voice client is not connected. Clearing queue.")
-        # Clean up all pending audio files
-        while queue:
-            _, filename = queue.popleft()
-            try:
-                if os.path.exists(filename):
-                    os.remove(filename)
-            except Exception as e:
-                print(f"Failed to remove audio file {filename}: {e}")
+    Clips are appended to the session's running ClipStream, so consecutive
+    clips share one play() call and play without a restart in between.
+    """
+    voice_client = session.voice_client
+    if (not voice_client or not voice_client.is_connected()) and session.reconnecting is not None:
+        # つなぎ直している間はクリップを捨てずに待つ
+        await asyncio.wait([session.reconnecting])
+        voice_client = session.voice_client
+    # ボイスクライアントが存在しない、または接続されていない場合は再生しない
+    if not voice_client or not voice_client.is_connected():
+        print("Voice client is not available or not connected. Skipping clip.")
         return
 
-    source = queue.popleft()
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def clip_done():
+        # ボイスのスレッドから呼ばれるのでループ側で完了させる
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+    source = OpusBufferSource(clip) if OPUS_PASSTHROUGH else PCMBufferSource(clip)
+    if session.stream is None or not session.stream.add(source, clip_done):
+        stream = ClipStream(OPUS_PASSTHROUGH, PLAYBACK_LINGER_FRAMES)
+        stream.add(source, clip_done)
+        await start_stream(session, voice_client, stream)
+    try:
+        await finished
+    except asyncio.CancelledError:
+        voice_client.stop()
+        raise
+
+
+async def start_stream(session: GuildSession, voice_client: discord.VoiceClient, stream: ClipStream):
+    loop = asyncio.get_running_loop()
+    # 前の再生が止まりきる前に play() すると弾かれるので待つ
+    if session.stream_stopped is not None and not session.stream_stopped.done():
+        await asyncio.wait([session.stream_stopped], timeout=1)
+    stopped = loop.create_future()
 
     def after_play(error):
         if error:
             print(f"Player error: {error}")
-        # Clean up the audio file after playing
-        try:
-            if os.path.exists(source[1]):
-                os.remove(source[1])
-        except Exception as e:
-            print(f"Failed to remove audio file {source[1]}: {e}")
-        # Continue playing next item in queue
-        play(voice_client, queue)
+            loop.call_soon_threadsafe(errors.inc, 'playback')
+        loop.call_soon_threadsafe(lambda: stopped.done() or stopped.set_result(None))
 
+    session.stream, session.stream_stopped = stream, stopped
     try:
-        voice_client.play(source[0], after=after_play)
-    except Exception as e:
-        print(f"Failed to play audio: {e}")
-        # Clean up the file even if play fails
-        try:
-            if os.path.exists(source[1]):
-                os.remove(source[1])
-        except Exception as cleanup_error:
-            print(f"Failed to remove audio file {source[1]}: {cleanup_error}")
-        # Try to play next item in queue
-        play(voice_client, queue)
+        voice_client.play(stream, after=after_play)
+    except Exception:
+        errors.inc('playback')
+        session.stream = None
+        # 待っている再生を終わらせる
+        stream.cleanup()
+        raise
 
 
 def current_milli_time() -> int:
@@ -116,194 +327,443 @@ def current_milli_time() -> int:
 
 
 async def addDict(arg1: str, arg2: str):
-    global dictMsg
-    msg = dictMsg.content + '\n' + arg1 + ',' + arg2
-    dictMsg = await dictMsg.edit(content=msg)
-    print(msg)
+    await asyncio.to_thread(dict_store.add, arg1, arg2)
+    schedule_dict_write_back()
+    print(f"Dictionary add: {arg1},{arg2}")
 
 
 def showDict() -> str:
-    global dictMsg
-    msg = dictMsg.content
-    lines = msg.splitlines()
-    print(lines)
     output = "現在登録されている辞書一覧\n"
-    for index, line in enumerate(lines):
-        if index:
-            pattern = line.strip().split(',')
-            output += "{0}: {1} -> {2}\n".format(index, pattern[0], pattern[1])
+    for index, (_, word, reading) in enumerate(dict_store.entries, 1):
+        line = "{0}: {1} -> {2}\n".format(index, word, reading)
+        # 返信も 2000 文字までなので収まらない分は件数だけ出す
+        if len(output) + len(line) > 1900:
+            output += f"...ほか{len(dict_store) - index + 1}件\n"
+            break
+        output += line
     return output
 
 
 async def removeDict(num: int) -> bool:
     if num <= 0:
         return True
-    global dictMsg
-    msg = dictMsg.content
-    lines = msg.splitlines()
-    output = []
-    for index, line in enumerate(lines):
-        if index != num:
-            output.append(line)
-    dictMsg = await dictMsg.edit(content='\n'.join(output))
+    if not await asyncio.to_thread(dict_store.remove, num):
+        return False
+    schedule_dict_write_back()
     return True
 
 
 def replaceDict(text: str) -> str:
-    global dictMsg
-    msg = dictMsg.content
-    lines = msg.splitlines()
-    for line in lines:
-        pattern = line.strip().split(',')
-        if pattern[0] in text and len(pattern) >= 2:
-            text = text.replace(pattern[0], pattern[1])
-    return text
+    return dict_store.replace(text)
 
 
-def replaceStamp(text: str) -> str:
-    text = re.sub('<:([^:]*):.*>', '\\1', text)
-    return text
+def schedule_dict_write_back():
+    global dict_write_task
+    if dict_write_task is None or dict_write_task.done():
+        dict_write_task = asyncio.create_task(write_back_dictionary())
 
 
-async def replaceUserName(text: str) -> str:
-    for word in text.split():
-        if not mention.match(word):
+async def write_back_dictionary():
+    """Mirror the local dictionary to the dict channel, batching changes"""
+    global dict_written_version
+    while dict_messages is not None and dict_written_version != dict_store.version:
+        try:
+            await asyncio.wait_for(dict_flushing.wait(), DICT_WRITE_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        version = dict_store.version
+        try:
+            await sync_dict_messages(render_messages(dict_store.pairs()))
+        except discord.NotFound:
+            # 辞書のメッセージが消されていたら送り直す
+            print("Dictionary message was deleted, sending it again")
+            dict_messages.clear()
             continue
-        print(word)
-        userId = re.sub('<@([^>]*)>', '\\1', word)
-        print(userId)
-        userName = str(await bot.fetch_user(userId))
-        userName = re.sub('#.*', '', userName)
-        text = text.replace(word, '@' + userName)
-    return text
+        except Exception as e:
+            print(f"Failed to write back dictionary: {type(e).__name__}: {e}")
+            continue
+        dict_written_version = version
+        print(f"Dictionary written back ({len(dict_store)} entries, {len(dict_messages)} messages)")
 
 
-async def jtalk(t) -> str:
-    open_jtalk = ['open_jtalk']
-    mech = ['-x', '/var/lib/mecab/dic/open-jtalk/naist-jdic']
-    htsvoice = ['-m', '/usr/share/hts-voice/mei/mei_normal.htsvoice']
-    pitch = ['-fm', '-5']
-    speed = ['-r', '1.0']
-    
-    # Generate unique filename to avoid conflicts
-    filename = f'output_{uuid.uuid4().hex[:8]}.wav'
-    outwav = ['-ow', filename]
-    cmd = open_jtalk + mech + htsvoice + pitch + speed + outwav
-    
+async def flush_dictionary(timeout: float = 10.0):
+    """Write back pending dictionary changes now instead of after DICT_WRITE_DELAY"""
+    dict_flushing.set()
+    schedule_dict_write_back()
     try:
-        c = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        with cleanup_lock:
-            active_processes.add(c)
-        
-        stdout, stderr = c.communicate(input=t.encode(), timeout=30)
-        
-        if c.returncode != 0:
-            raise Exception(f"OpenJTalk failed: {stderr.decode()}")
-            
-        return filename
-    except subprocess.TimeoutExpired:
-        c.kill()
-        raise Exception("OpenJTalk timeout")
-    except Exception as e:
-        if os.path.exists(filename):
-            os.remove(filename)
-        raise e
-    finally:
-        with cleanup_lock:
-            active_processes.discard(c)
+        await asyncio.wait_for(asyncio.shield(dict_write_task), timeout)
+    except asyncio.TimeoutError:
+        print("Timed out writing back the dictionary before shutdown")
 
 
-def get_voice_client(channel_id: int) -> discord.VoiceClient | None:
-    for client in bot.voice_clients:
-        if client.channel and client.channel.id == channel_id:
-            return client
-    else:
-        return None
+async def shutdown():
+    """Write back the dictionary, then log out so main() can clean up"""
+    await flush_dictionary()
+    await bot.close()
+
+
+async def sync_dict_messages(contents: list[str]):
+    channel = bot.get_channel(dictID)
+    for index, content in enumerate(contents):
+        if index < len(dict_messages):
+            if dict_messages[index].content != content:
+                dict_messages[index] = await dict_messages[index].edit(content=content)
+        else:
+            dict_messages.append(await channel.send(content))
+    for message in dict_messages[len(contents):]:
+        await message.delete()
+    del dict_messages[len(contents):]
+
+
+async def refresh_dictionary():
+    """Pick up dictionary changes made by the other shard processes"""
+    while True:
+        await asyncio.sleep(DICT_REFRESH_INTERVAL)
+        try:
+            if await asyncio.to_thread(dict_store.refresh):
+                print(f"Dictionary reloaded ({len(dict_store)} entries)")
+                schedule_dict_write_back()
+        except Exception as e:
+            print(f"Failed to refresh dictionary: {type(e).__name__}: {e}")
 
 
-async def check_voice_client_health(voice_client: discord.VoiceClient) -> bool:
-    """Check if voice client is healthy and can play audio"""
+async def load_dict_messages(channel: discord.TextChannel):
+    """Find the dictionary messages; import them if the local store is empty"""
+    global dict_messages, dict_written_version
+    messages = []
     try:
-        if not voice_client or not voice_client.is_connected():
-            return False
-        # Test if the voice client is responsive
-        return True
+        # 新しい方から、辞書の先頭行で始まるメッセージまでを辞書とみなす
+        async for message in channel.history(limit=50):
+            if message.author != bot.user:
+                break
+            messages.append(message)
+            if message.content.startswith(DICT_HEADER):
+                break
     except Exception as e:
-        print(f"Voice client health check failed: {e}")
-        return False
+        print(f"Failed to read dictionary messages: {type(e).__name__}: {e}")
+        return
+    messages.reverse()
+    dict_messages = messages
+    if not len(dict_store) and messages:
+        entries = parse_entries('\n'.join(message.content for message in messages))
+        await asyncio.to_thread(dict_store.import_entries, entries)
+        print(f"Imported {len(entries)} dictionary entries from Discord")
+    elif [message.content for message in messages] != render_messages(dict_store.pairs()):
+        # 前回書き戻す前に終了していたら、ローカルの内容で揃える
+        dict_written_version = -1
+    schedule_dict_write_back()
 
 
-async def ensure_voice_connection(guild: discord.Guild, channel_id: int) -> discord.VoiceClient | None:
-    """Ensure we have a healthy voice connection"""
-    voice_client = get_voice_client(channel_id)
-    
-    if voice_client and await check_voice_client_health(voice_client):
+def replaceStamp(text: str) -> str:
+    text = re.sub('<:([^:]*):.*>', '\\1', text)
+    return text
+
+
+async def replaceUserName(text: str, guild: discord.Guild) -> str:
+    """Replace user, role and channel mentions with names to read out"""
+    user_ids = {
+        int(m.group(2)) for m in mention.finditer(text)
+        if m.group(1) != '@&' and m.group(1) != '#' and int(m.group(2)) not in userNicknameDict
+    }
+    names = await name_resolver.resolve(guild, user_ids) if user_ids else {}
+
+    def name_of(m: re.Match) -> str:
+        kind, target = m.group(1), int(m.group(2))
+        if kind == '@&':
+            role = guild.get_role(target)
+            return '@' + role.name if role else m.group(0)
+        if kind == '#':
+            channel = guild.get_channel_or_thread(target)
+            return '#' + channel.name if channel else m.group(0)
+        if target in userNicknameDict:
+            return '@' + userNicknameDict[target]
+        if target in names:
+            return '@' + names[target]
+        return m.group(0)
+
+    return mention.sub(name_of, text)
+
+
+async def jtalk(t, params: VoiceParams = DEFAULT_VOICE) -> tuple[bytes, int]:
+    """Synthesize text and return (16bit mono PCM, sample rate)"""
+    return await synthesis_engine.synthesize(t, params)
+
+
+class _Rendering:
+    """One in-flight synthesis shared by every render() call for the same clip"""
+    __slots__ = ('task', 'ticket', 'waiters')
+
+    def __init__(self, ticket: Ticket):
+        self.task: asyncio.Task | None = None
+        self.ticket = ticket
+        self.waiters = 0
+
+    def join(self, ticket: Ticket):
+        # 一番遅い期限に合わせる(期限の無い人がいれば期限なし)。先に来た人の期限切れで他の人の分まで捨てない
+        if self.ticket.deadline is not None:
+            if ticket.deadline is None:
+                self.ticket.deadline = None
+            else:
+                self.ticket.deadline = max(self.ticket.deadline, ticket.deadline)
+        # 事前合成に今読む人や挨拶が相乗りしたら、後回しの順番のままにせず繰り上げる
+        if (self.ticket.background and not ticket.background) or (ticket.urgent and not self.ticket.urgent):
+            self.ticket.background = self.ticket.background and ticket.background
+            self.ticket.urgent = self.ticket.urgent or ticket.urgent
+            synthesis_scheduler.promote(self.ticket)
+
+
+async def render(text: str, params: VoiceParams = DEFAULT_VOICE, ticket: Ticket | None = None,
+                 gain: float = 1.0) -> bytes:
+    """Return ready-to-play audio for text, synthesizing only on a cache miss
+
+    Synthesis waits for its turn in synthesis_scheduler according to ticket.
+    gain is the guild's volume, applied once when the clip is made.
+    Concurrent calls for the same clip share one synthesis, which is
+    cancelled only when every caller has gone.
+    """
+    ticket = ticket or Ticket()
+    key = audio_cache.key(text, params, CLIP_ENCODING, gain)
+    # 同じ文言を同時に合成しないように、合成中のものがあればそれを待つ
+    job = rendering.get(key)
+    if job is None:
+        clip = await audio_cache.get(key)
+        if clip is not None:
+            return clip
+        job = rendering.get(key)
+    if job is None:
+        job = rendering[key] = _Rendering(dataclasses.replace(ticket))
+        job.task = asyncio.create_task(synthesize_clip(key, text, params, job.ticket, gain))
+        job.task.add_done_callback(lambda task: finish_rendering(key, job))
+    else:
+        job.join(ticket)
+    job.waiters += 1
+    try:
+        return await asyncio.shield(job.task)
+    finally:
+        job.waiters -= 1
+        if not job.waiters and not job.task.done():
+            job.task.cancel()
+            # 止めた合成に後から来た人が相乗りしないように、すぐ外す
+            if rendering.get(key) is job:
+                del rendering[key]
+
+
+def finish_rendering(key: str, job: _Rendering):
+    if rendering.get(key) is job:
+        del rendering[key]
+    # 待っている人がいなくても警告が出ないようにしておく
+    if not job.task.cancelled():
+        job.task.exception()
+
+
+async def synthesize_clip(key: str, text: str, params: VoiceParams, ticket: Ticket, gain: float) -> bytes:
+    queued = time.monotonic()
+    async with synthesis_scheduler.slot(ticket, len(text)):
+        tracing.mark('queue')
+        started = time.monotonic()
+        queue_wait.observe(started - queued)
+        if TTS_SERVER:
+            # 変換・エンコードまで合成サーバーで済ませる
+            clip = await synthesis_engine.render(text, params, CLIP_ENCODING, gain)
+        else:
+            pcm, rate = await jtalk(text, params)
+    if not TTS_SERVER:
+        clip = await asyncio.to_thread(make_clip, pcm, rate, CLIP_ENCODING, gain)
+    synthesis_time.observe(time.monotonic() - started)
+    await audio_cache.put(key, clip)
+    return clip
+
+
+def backoff_delay(attempt: int, cap: float) -> float:
+    """Randomized exponential backoff so many guilds do not retry in lockstep"""
+    return random.uniform(0, min(cap, 2 ** attempt))
+
+
+async def ensure_voice_connection(guild: discord.Guild, channel: discord.VoiceChannel,
+                                  attempts: int = 3) -> discord.VoiceClient:
+    """Return a connected voice client in channel, moving the guild's current one if it has one"""
+    voice_client = guild.voice_client
+    if voice_client is not None and voice_client.is_connected():
+        if voice_client.channel.id != channel.id:
+            # 切断せずに移動するので、再生中のクリップや待ちはそのまま
+            print(f"Moving from voice channel {voice_client.channel.name} to {channel.name}")
+            await voice_client.move_to(channel)
         return voice_client
-    
-    # Reconnect if connection is unhealthy
-    if voice_client:
+    if voice_client is not None:
+        # 壊れた接続は待たずに捨てる
+        try:
+            await voice_client.disconnect(force=True)
+        except Exception as e:
+            print(f"Error disconnecting stale voice client: {e}")
+    return await connect_with_retry(channel, max_attempts=attempts, timeout_per_attempt=10.0)
+
+
+def attach_voice(guild: discord.Guild, text_channel_id: int, voice_client: discord.VoiceClient) -> GuildSession:
+    """Point the guild's session at voice_client, keeping its queue; start one if there is none"""
+    session = sessions.get(guild.id)
+    if session is None:
+        return start_session(guild, text_channel_id, voice_client)
+    session.text_channel_id = text_channel_id
+    if session.voice_client is not voice_client:
+        session.voice_client = voice_client
+        # 前の接続での再生は止まっているので、次のクリップから作り直す
+        session.stream = None
+    if session.reconnecting is not None and session.reconnecting is not asyncio.current_task():
+        session.reconnecting.cancel()
+        session.reconnecting = None
+    return session
+
+
+async def reconnect_voice(session: GuildSession, channel: discord.VoiceChannel):
+    """Rejoin channel in the background after the connection dropped, keeping the queue"""
+    lost = time.monotonic()
+    for attempt in range(1, VOICE_RECONNECT_ATTEMPTS + 1):
+        await asyncio.sleep(backoff_delay(attempt, VOICE_RECONNECT_BACKOFF))
+        if sessions.get(session.guild_id) is not session:
+            return
         try:
+            voice_client = await ensure_voice_connection(channel.guild, channel, attempts=1)
+        except Exception as e:
+            print(f"Voice reconnect attempt {attempt} failed: {type(e).__name__}: {e}")
+            continue
+        if sessions.get(session.guild_id) is not session:
+            # つなぎ直している間に /dc された
             await voice_client.disconnect()
-        except:
-            pass
-    
-    try:
-        channel = bot.get_channel(channel_id)
-        if channel:
-            return await channel.connect()
-    except Exception as e:
-        print(f"Failed to reconnect to voice channel: {e}")
-        return None
+            return
+        attach_voice(channel.guild, session.text_channel_id, voice_client)
+        session.reconnecting = None
+        elapsed = time.monotonic() - lost
+        voice_reconnect_time.observe(elapsed)
+        print(f"Reconnected to voice channel {channel.name} in {elapsed:.1f}s")
+        return
+    print(f"Giving up reconnecting to voice channel {channel.name}")
+    session.reconnecting = None
+    sessions.remove(session.guild_id)
+    text_channel = channel.guild.get_channel(session.text_channel_id)
+    if text_channel is not None:
+        await text_channel.send('ボイスチャンネルに再接続できなかったので読み上げを終了しました')
 
 
-async def text_check(text: str, user_name: str) -> tuple[str, str]:
+async def text_check(text: str, user_name: str, guild: discord.Guild) -> str:
     print(text)
-    if len(text) > 150:
+    if len(text) > MAX_TEXT_LENGTH:
         raise Exception("文字数が長すぎるよ")
     if stamp.search(text):
         text = replaceStamp(text)
     if mention.search(text):
-        text = await replaceUserName(text)
+        text = await replaceUserName(text, guild)
+    tracing.mark('mentions')
 
     # 改行を句点に置き換え
     text = text.replace('\n', '。')
     text = re.sub('http.*', '', text)
     text = replaceDict(text)
     text = user_name + text
-    if len(text) > 150:
+    if len(text) > MAX_TEXT_LENGTH:
         raise Exception("文字数が長すぎるよ")
-    
-    try:
-        filename = await jtalk(text)
-        if os.path.getsize(filename) > 10000000:
-            if os.path.exists(filename):
-                os.remove(filename)
-            raise Exception("再生時間が長すぎるよ")
-        return text, filename
-    except Exception as e:
-        print(f"TTS generation failed: {e}")
-        raise e
+    tracing.mark('dictionary')
+    return text
+
+
+def split_segments(text: str) -> list[str]:
+    """Split text at sentence ends, and at commas when a sentence is long"""
+    segments = []
+    for sentence in sentence_end.split(text):
+        sentence = sentence.strip()
+        # 長い文は読点でも区切る
+        while len(sentence) > SEGMENT_LENGTH:
+            cut = max(sentence.rfind(p, 0, SEGMENT_LENGTH) for p in '、，, 　')
+            if cut <= 0:
+                cut = SEGMENT_LENGTH - 1
+            segments.append(sentence[:cut + 1])
+            sentence = sentence[cut + 1:].strip()
+        if not sentence:
+            continue
+        # 句読点だけ・数文字だけの区切りは前とまとめる
+        if segments and len(sentence) < 4:
+            segments[-1] += sentence
+        else:
+            segments.append(sentence)
+    return segments
+
+
+def percentile_summary(label: str, samples) -> str:
+    samples = sorted(samples)
+    if not samples:
+        return f"{label}: -"
+    p50 = samples[len(samples) // 2]
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"{label}: p50 {p50:.0f}ms / p95 {p95:.0f}ms ({len(samples)}件)"
+
+
+def ttfa_summary(session: GuildSession) -> str:
+    return percentile_summary("最初の音まで", session.ttfa)
+
+
+def queue_wait_summary(session: GuildSession) -> str:
+    return (
+        f"{percentile_summary('合成の順番待ち', session.queue_wait)} "
+        f"(全体 待ち {len(synthesis_scheduler)} / 合成中 {synthesis_scheduler.in_use}, "
+        f"期限切れ {synthesis_scheduler.expired})\n"
+    )
 
 
 client_id = os.environ['DISCORD_CLIENT_ID']
 application_id = os.environ['DISCORD_APP_ID']
+# 使うイベントだけを受け取り、メンバーとメッセージをキャッシュしない(0 なら全部受け取る)
+GATEWAY_LEAN = os.environ.get('GATEWAY_LEAN', '1') != '0'
+
+
+def gateway_options() -> dict:
+    if not GATEWAY_LEAN:
+        return dict(intents=discord.Intents.all())
+    intents = discord.Intents.none()
+    # チャンネルの一覧、読み上げるメッセージ、入退室の検知
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.voice_states = True
+    member_cache_flags = discord.MemberCacheFlags.none()
+    # ボイスチャンネルにいる人だけ覚える(自動退出の判定に使う)
+    member_cache_flags.voice = True
+    return dict(
+        intents=intents,
+        member_cache_flags=member_cache_flags,
+        max_messages=None,
+        chunk_guilds_at_startup=False,
+    )
+
+
 # クライアント、コマンドツリーを作成
-bot = commands.Bot(
-    command_prefix="/",
-    intents=discord.Intents.all(),
-    application_id=application_id
-)
+if SHARD_COUNT or SHARD_IDS:
+    bot = commands.AutoShardedBot(
+        command_prefix="/",
+        application_id=application_id,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT.isdigit() else None,
+        shard_ids=SHARD_IDS,
+        **gateway_options(),
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="/",
+        application_id=application_id,
+        **gateway_options(),
+    )
 tree = bot.tree
+dict_refresh_task: asyncio.Task | None = None
+metrics_server: asyncio.AbstractServer | None = None
+# メンションの名前解決。メンバーキャッシュにいない人の名前は TTL 付きで覚えておく
+# (メンバーをキャッシュしないときは、発言や入退室で見かけた名前もここに入れる)
+name_resolver = NameResolver(bot, NameCache(
+    int(os.environ.get('NAME_CACHE_SIZE', '10000')), float(os.environ.get('NAME_CACHE_TTL', '600'))))
 # client = discord.Client(intents=discord.Intents.all())
 # tree = discord.app_commands.CommandTree(client)
 
-voice = None
-volume = None
-currentChannel = None
-
 url = re.compile('^http')
-mention = re.compile('<@[^>]*>')
+# <@id> <@!id> はユーザー、<@&id> はロール、<#id> はチャンネル
+mention = re.compile('<(@!?|@&|#)([0-9]+)>')
 stamp = re.compile('<:([^:]*):.*>')
+sentence_end = re.compile('(?<=[。．！？!?])')
 
 
 @bot.event
@@ -311,20 +771,32 @@ async def on_ready():
     # 起動時の処理
     print(f"Bot logged in as {bot.user} (ID: {bot.user.id})")
 
-    global dictMsg
+    global dict_refresh_task, metrics_server
     try:
         channel = bot.get_channel(dictID)
-        if channel is None:
+        if channel is None and SHARED_PROCESS:
+            # 辞書チャンネルのサーバーは別のプロセスの担当。辞書はデータベース経由で共有する
+            print(f"Dictionary channel {dictID} belongs to another shard process")
+        elif channel is None:
             raise Exception(f"Dictionary channel with ID {dictID} not found. Please check DICT_CH_ID environment variable.")
-        print(f"Found dictionary channel: {channel.name} (ID: {channel.id})")
-
-        async for message in channel.history(limit=1):
-            if message.author == bot.user:
-                dictMsg = message
-            else:
-                dictMsg = await channel.send('文字列,文字列')
-
-        await tree.sync()
+        else:
+            print(f"Found dictionary channel: {channel.name} (ID: {channel.id})")
+
+        # 辞書はローカルから読むので、チャンネルの読み込みは待たない
+        print(f"Loaded {len(dict_store)} dictionary entries")
+        if channel is not None and dict_messages is None:
+            asyncio.create_task(load_dict_messages(channel))
+        if SHARED_PROCESS and dict_refresh_task is None:
+            dict_refresh_task = asyncio.create_task(refresh_dictionary())
+        if METRICS_PORT and metrics_server is None:
+            metrics_server = await metrics.serve(registry, METRICS_HOST, METRICS_PORT)
+
+        # コマンドはアプリ全体で共通なので、登録はシャード0を持つプロセスだけが行う
+        if not SHARD_IDS or 0 in SHARD_IDS:
+            await tree.sync()
+        # 最初のメッセージで辞書の読み込みを待たないようにワーカーを先に起動しておく
+        synthesis_engine.start()
+        print(memory_summary().strip())
         print('Bot is wake up. hi bro.')
     except Exception as e:
         print(f"FATAL ERROR during startup: {e}")
@@ -346,18 +818,36 @@ async def f(interaction:discord.Interaction):
 """
 
 
+class TTSVoiceClient(discord.VoiceClient):
+    """VoiceClient that remembers whether Discord removed it from the channel"""
+
+    def __init__(self, client: discord.Client, channel: discord.abc.Connectable):
+        super().__init__(client, channel)
+        # 切断ボタンやチャンネルの削除でサーバー側から外された
+        self.removed = False
+
+    async def on_voice_state_update(self, data):
+        # 接続が失敗したときは discord.py が先に自分で切ってから退出が届くので、
+        # 接続したまま退出が届いたらサーバー側から外されたもの
+        if data['channel_id'] is None and self.is_connected():
+            self.removed = True
+        await super().on_voice_state_update(data)
+
+
 async def connect_with_retry(voice_channel, max_attempts=3, timeout_per_attempt=10.0):
     """
     Try to connect to voice channel with retry logic.
     Returns: VoiceClient if successful, None otherwise
     """
     for attempt in range(1, max_attempts + 1):
+        if attempt > 1:
+            voice_reconnects.inc()
         try:
             print(f"Connection attempt {attempt}/{max_attempts} (timeout={timeout_per_attempt}s)...")
 
             # Use shorter timeout for each attempt to fail fast
             vc = await asyncio.wait_for(
-                voice_channel.connect(timeout=timeout_per_attempt, reconnect=False),
+                voice_channel.connect(timeout=timeout_per_attempt, reconnect=False, cls=TTSVoiceClient),
                 timeout=timeout_per_attempt + 2.0
             )
 
@@ -376,14 +866,14 @@ async def connect_with_retry(voice_channel, max_attempts=3, timeout_per_attempt=
         except asyncio.TimeoutError:
             print(f"Attempt {attempt} timed out after {timeout_per_attempt}s")
             if attempt < max_attempts:
-                wait_time = min(2 ** attempt, 5)  # Exponential backoff, max 5s
-                print(f"Waiting {wait_time}s before retry...")
+                wait_time = backoff_delay(attempt, 5)  # Exponential backoff with jitter, max 5s
+                print(f"Waiting {wait_time:.1f}s before retry...")
                 await asyncio.sleep(wait_time)
         except Exception as e:
             print(f"Attempt {attempt} failed: {type(e).__name__}: {str(e)}")
             if attempt < max_attempts:
-                wait_time = min(2 ** attempt, 5)
-                print(f"Waiting {wait_time}s before retry...")
+                wait_time = backoff_delay(attempt, 5)
+                print(f"Waiting {wait_time:.1f}s before retry...")
                 await asyncio.sleep(wait_time)
             else:
                 raise
@@ -405,45 +895,37 @@ async def join(interaction: discord.Interaction):
 
     # Check if already connected to a voice channel in this guild
     existing_vc = interaction.guild.voice_client
-    if existing_vc:
-        if existing_vc.channel.id == voice_channel.id:
-            await interaction.followup.send(f'既にボイスチャンネル「{voice_channel.name}」に参加しています')
-            return
-        else:
-            # Disconnect from current channel first
-            print(f"Disconnecting from existing voice channel: {existing_vc.channel.name}")
-            try:
-                await existing_vc.disconnect(force=True)
-                await asyncio.sleep(1)
-            except Exception as e:
-                print(f"Error disconnecting from existing channel: {e}")
+    if (existing_vc and existing_vc.is_connected() and existing_vc.channel.id == voice_channel.id
+            and sessions.get(interaction.guild.id) is not None):
+        await interaction.followup.send(f'既にボイスチャンネル「{voice_channel.name}」に参加しています')
+        return
 
     connecting_channels.add(interaction.channel_id)
     await interaction.followup.send(f'ボイスチャンネル「{voice_channel.name}」に接続を試みています...')
 
     try:
-        global currentChannel
         print(f"Opus loaded: {discord.opus.is_loaded()}")
         print(f"Voice channel: {voice_channel.name} (ID: {voice_channel.id})")
 
-        # Use retry logic with shorter timeouts to fail fast
-        vc = await connect_with_retry(voice_channel, max_attempts=3, timeout_per_attempt=10.0)
-
-        # Set current channel only after successful connection
-        currentChannel = interaction.channel_id
+        # 別のチャンネルにいるなら移動、いなければ retry 付きで接続する
+        vc = await ensure_voice_connection(interaction.guild, voice_channel)
 
         # Verify guild voice client
         guild_vc = interaction.guild.voice_client
         if not guild_vc or not guild_vc.is_connected():
             raise Exception("Guild voice client not available after connection")
 
+        # Start the session only after successful connection (moving keeps the existing one)
+        session = attach_voice(interaction.guild, interaction.channel_id, guild_vc)
+        prerender_greetings(session, voice_channel.members)
+
         print(f"Successfully connected to voice channel: {voice_channel.name}")
         print(f"Voice client status: connected={vc.is_connected()}, latency={vc.latency:.2f}ms")
         await interaction.followup.send(f'✓ ボイスチャンネル「{voice_channel.name}」に接続しました')
 
     except asyncio.TimeoutError as e:
         connecting_channels.discard(interaction.channel_id)
-        currentChannel = None
+        sessions.remove(interaction.guild.id)
         error_msg = "ボイス接続がタイムアウトしました"
         print(f"ERROR: {error_msg}")
         import traceback
@@ -452,7 +934,7 @@ async def join(interaction: discord.Interaction):
 
     except Exception as e:
         connecting_channels.discard(interaction.channel_id)
-        currentChannel = None
+        sessions.remove(interaction.guild.id)
         error_msg = f"{type(e).__name__}: {str(e)}"
         print(f"ERROR: Failed to connect - {error_msg}")
         import traceback
@@ -463,24 +945,82 @@ async def join(interaction: discord.Interaction):
 @tree.command(name="dc", description="ボイスチャンネルから退出するよ")
 async def dc(interaction: discord.Interaction):
     await interaction.response.defer()
-    client: discord.VoiceClient | None = get_voice_client(
-        interaction.channel_id)
-
-    if client:
-        global currentChannel
-        currentChannel = None
-        # キューをクリアして蓄積されたメッセージを削除
-        if interaction.guild.id in queue_dict:
-            queue_dict[interaction.guild.id].clear()
-        await client.disconnect()
+    client: discord.VoiceClient | None = interaction.guild.voice_client
+    # キューをクリアして蓄積されたメッセージを削除(つなぎ直し中ならそれも止める)
+    session = sessions.remove(interaction.guild.id)
+
+    if client or session:
+        if client:
+            await client.disconnect()
         await interaction.followup.send('ボイスチャンネルからログアウトしました')
     else:
         await interaction.followup.send('ボイスチャンネルに参加していません')
 
 
+def backlog_summary(session: GuildSession) -> str:
+    stats = session.pipeline.stats
+    return (
+        f"待ち: {len(session.pipeline)}件 (破棄 {stats.dropped} / 期限切れ {stats.stale} / "
+        f"結合 {stats.coalesced} / 早口 {stats.sped_up})\n"
+    )
+
+
+def admission_summary() -> str:
+    rejected = admission.rejected
+    return (
+        f"受付: {admission.admitted}件 (連投 {rejected['user']} / サーバー {rejected['guild']} / "
+        f"重複 {rejected['repeat']})\n"
+    )
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # /proc が無い環境ではピーク値で代用する
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_summary() -> str:
+    rss = rss_bytes() / 1024 / 1024
+    guilds = len(bot.guilds)
+    # RSS をサーバー数で割るのでインタプリタや numpy などの固定分も含んだ上限になる。
+    # GATEWAY_LEAN で減る分は python -m benchmarks.load --scenarios gateway で測る
+    per_1k = f"{rss / guilds * 1000:.1f}MB" if guilds else "-"
+    members = sum(len(guild.members) for guild in bot.guilds)
+    return (
+        f"メモリ: RSS {rss:.1f}MB (1000サーバーあたり最大 {per_1k}・固定分込み, {guilds}サーバー, "
+        f"キャッシュ中のメンバー {members}人, 名前 {len(name_resolver.cache)}件)\n"
+    )
+
+
+def loop_status() -> str:
+    return loop_monitor.summary() + "\n" if loop_monitor.enabled else ""
+
+
+def stage_summary(session: GuildSession) -> str:
+    stages = tracer.summary(session.guild_id)
+    if not stages:
+        return ""
+    return "段階別 p50/p95(ms): " + ", ".join(
+        f"{stage} {p50:.0f}/{p95:.0f}" for stage, (p50, p95, _) in stages.items()) + "\n"
+
+
+def cache_status() -> str:
+    lookups = audio_cache.hits + audio_cache.disk_hits + audio_cache.misses
+    hit_rate = (audio_cache.hits + audio_cache.disk_hits) / lookups * 100 if lookups else 0
+    return (
+        f"キャッシュ: {len(audio_cache)}件 {audio_cache.memory_bytes / 1024 / 1024:.1f}MB "
+        f"(ヒット {audio_cache.hits} / ディスク {audio_cache.disk_hits} / ミス {audio_cache.misses}, {hit_rate:.0f}%)"
+    )
+
+
 @tree.command(name="status", description="現在のステータスを確認するよ")
 async def status_cmd(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
+    session = sessions.get(interaction.guild.id)
 
     if voice_client and voice_client.is_connected():
         channel_name = voice_client.channel.name if voice_client.channel else "不明"
@@ -490,12 +1030,21 @@ async def status_cmd(interaction: discord.Interaction):
             f"チャンネル: {channel_name}\n"
             f"遅延: {latency:.2f}ms\n"
             f"再生中: {'はい' if voice_client.is_playing() else 'いいえ'}\n"
-            f"Opus loaded: {'はい' if discord.opus.is_loaded() else 'いいえ'}"
+            f"Opus loaded: {'はい' if discord.opus.is_loaded() else 'いいえ'}\n"
+            f"{ttfa_summary(session) if session else '読み上げ: 停止中'}\n"
+            f"{stage_summary(session) if session else ''}"
+            f"{backlog_summary(session) if session else ''}"
+            f"{queue_wait_summary(session) if session else ''}"
+            f"{admission_summary()}"
+            f"{loop_status()}"
+            f"{memory_summary()}"
+            f"{cache_status()}"
         )
     else:
         status = (
             f"✗ ボイスチャンネルに接続していません\n"
-            f"Opus loaded: {'はい' if discord.opus.is_loaded() else 'いいえ'}"
+            f"Opus loaded: {'はい' if discord.opus.is_loaded() else 'いいえ'}\n"
+            f"{cache_status()}"
         )
 
     await interaction.response.send_message(status)
@@ -503,22 +1052,39 @@ async def status_cmd(interaction: discord.Interaction):
 
 @tree.command(name="volume", description="音量を調整するよ")
 async def vol(interaction: discord.Interaction, control: str):
-    global volume
+    session = sessions.get(interaction.guild.id)
+    if session is None:
+        return await interaction.response.send_message('ボイスチャンネルに参加していません')
 
+    # 次に合成するクリップから反映される(音量ごとにキャッシュするので 0.1 刻みに揃える)
     if control == "up":
-        volume += 0.1
-        await interaction.response.send_message(f"音量を上げました\n現在の音量:{volume}")
+        session.volume = min(MAX_VOLUME, round(session.volume + 0.1, 1))
+        await interaction.response.send_message(f"音量を上げました\n現在の音量:{session.volume:.1f}")
     elif control == "down":
-        volume -= 0.1
-        await interaction.response.send_message(f"音量を下げました\n現在の音量:{volume}")
+        session.volume = max(MIN_VOLUME, round(session.volume - 0.1, 1))
+        await interaction.response.send_message(f"音量を下げました\n現在の音量:{session.volume:.1f}")
     else:
-        await interaction.response.send_message(f"up もしくは down を入力してください\n現在の音量:{volume}")
+        return await interaction.response.send_message(
+            f"up もしくは down を入力してください\n現在の音量:{session.volume:.1f}")
+    # 新しい音量で挨拶を作り直しておく
+    if session.is_connected():
+        prerender_greetings(session, session.voice_client.channel.members)
+
+
+@tree.command(name="monitor", description="イベントループの遅れの計測を切り替えるよ")
+async def monitor(interaction: discord.Interaction, control: str = ""):
+    if control == "on":
+        loop_monitor.start()
+    elif control == "off":
+        loop_monitor.stop()
+    state = "計測中" if loop_monitor.enabled else "停止中"
+    await interaction.response.send_message(f"ループの監視: {state} (on / off で切り替え)\n{loop_monitor.summary()}")
 
 
 @tree.command(name="bye", description="クライアント終了、仕様上動くかわかんない")
 async def bye(interaction: discord.Interaction):
     await interaction.response.send_message("クライアントを終了します")
-    await bot.close()
+    await shutdown()
 
 
 @tree.command(name="kill", description="ボットプロセスを強制終了します")
@@ -563,77 +1129,109 @@ async def rename(interaction: discord.Interaction, name: str=None):
         return await interaction.response.send_message("荒らしは許されませんよ♡\n呼び方は10文字儼にしてね")
     userNicknameDict[interaction.user.id] = name
     await interaction.response.send_message(f"あなたの呼び方を{name}に変えたよ")
+    session = sessions.get(interaction.guild_id)
+    if session is not None:
+        prerender_greetings(session, [interaction.user])
 
 @bot.event
 async def on_message(message: discord.Message):
     # テキストチャンネルにメッセージが送信されたときの処理
-    global volume
 
     # botの排除
-    if message.author.bot:
+    if message.author.bot or message.guild is None:
         return await bot.process_commands(message)
-    volume = 0.5
 
-    # Use guild's voice client directly instead of looking up by text channel ID
-    voice_client = message.guild.voice_client
-
-    if not voice_client or not voice_client.is_connected():
+    # Check if the guild has a session and the message is from its linked text channel
+    session = sessions.get(message.guild.id)
+    if session is None or session.text_channel_id != message.channel.id:
         return await bot.process_commands(message)
 
-    # Check if the bot is in a voice channel and the message is from the linked text channel
-    if currentChannel != message.channel.id:
+    if not session.is_connected():
         return await bot.process_commands(message)
 
+    # 以降の段階(合成・再生まで)の時間を記録する
+    tracer.begin(message.guild.id, message.id)
     text = message.content
 
+    name_resolver.remember(message.author)
     if message.author.id in userNicknameDict:
         user_name=userNicknameDict[message.author.id]
     else:
         user_name=message.author.display_name
 
-    try:
-        text, filename = await text_check(text, user_name)
-    except Exception as e:
-        print(f"Text processing error: {e}")
-        return await message.channel.send(f"読み上げエラー: {e}")
+    # 連投や同じ文面の繰り返しは合成する前に弾く
+    if admission.admit(message.guild.id, message.author.id, text) is not None:
+        # 弾くたびに投稿すると余計に荒れるので、通知はたまにだけ
+        if admission.should_notify(message.guild.id):
+            asyncio.create_task(message.channel.send("メッセージが多すぎるので一部を読み飛ばしているよ"))
+        return await bot.process_commands(message)
 
-    try:
-        enqueue(voice_client, message.guild,
-                discord.FFmpegPCMAudio(filename), filename)
-    except Exception as e:
-        print(f"Audio enqueue error: {e}")
-        # Clean up file if enqueue fails
-        if os.path.exists(filename):
-            os.remove(filename)
-        return await message.channel.send("音声の再生に失敗しました")
+    tracing.mark('admission')
+
+    # 到着順に並べてから合成するので、ここでは待たない
+    received = time.monotonic()
+    session.messages_read += 1
+    session.pipeline.submit(
+        lambda: read_message(message, text, user_name),
+        on_error=lambda e: report_error(message.channel, e),
+        on_start=lambda: record_latency(session, time.monotonic() - received))
     
     # コマンド側へメッセージ内容を渡す
     await bot.process_commands(message)
 
+def record_latency(session: GuildSession, seconds: float):
+    session.ttfa.append(seconds * 1000)
+    message_latency.observe(seconds)
+
+
+async def read_message(message: discord.Message, text: str, user_name: str) -> list[str]:
+    try:
+        text = await text_check(text, user_name, message.guild)
+    except Exception as e:
+        print(f"Text processing error: {e}")
+        errors.inc('text')
+        await message.channel.send(f"読み上げエラー: {e}")
+        return []
+    return split_segments(text) if TTS_STREAMING else [text]
+
+
+def report_error(channel: discord.abc.Messageable, error: Exception):
+    errors.inc('synthesis')
+    asyncio.create_task(channel.send(f"読み上げエラー: {error}"))
+
+
 @bot.event
 async def on_voice_state_update(member: discord.Member, before:discord.VoiceState, after:discord.VoiceState):
-    # Chatに接続中でないなら処理しない
-    global currentChannel
-    if currentChannel is None:
+    # このサーバーで読み上げ中でないなら処理しない
+    session = sessions.get(member.guild.id)
+    if session is None:
+        return
+    if member.id == bot.user.id:
+        # 接続が切れたら、待ちを残したままつなぎ直す(/dc などで終えたときはセッションが無い)。
+        # 切断ボタンやチャンネルの削除で外されたときは読み上げを終える
+        if before.channel and not after.channel and session.reconnecting is None:
+            if session.voice_client.removed:
+                print(f"Removed from voice channel {before.channel.name}, ending the session")
+                sessions.remove(member.guild.id)
+            elif VOICE_RECONNECT_ATTEMPTS:
+                print(f"Lost voice connection to {before.channel.name}, reconnecting")
+                session.reconnecting = asyncio.create_task(reconnect_voice(session, before.channel))
+            else:
+                sessions.remove(member.guild.id)
         return
+    name_resolver.remember(member)
     if member.id in userNicknameDict:
         username=userNicknameDict[member.id]
     else:
         username=member.display_name
     if not before.channel and after.channel:
-        try:
-            filename = await jtalk(username +"さんこんにちは！")
-            enqueue(member.guild.voice_client, member.guild,
-                    discord.FFmpegPCMAudio(filename), filename)
-        except Exception as e:
-            print(f"Failed to play greeting: {e}")
+        session.pipeline.submit_text(GREETING_JOIN.format(username), urgent=True)
+        # 退出のときもすぐ読めるようにしておく
+        prerender_greetings(session, [member])
     if before.channel and not after.channel:
-        try:
-            filename = await jtalk(username + "さんが退出しました")
-            enqueue(member.guild.voice_client, member.guild,
-                    discord.FFmpegPCMAudio(filename), filename)
-        except Exception as e:
-            print(f"Failed to play farewell: {e}")
+        session.pipeline.submit_text(GREETING_LEAVE.format(username), urgent=True)
+    if not before.channel:
+        return
     allbot = True    
     selfcheck = False
     for mem in before.channel.members:
@@ -641,15 +1239,28 @@ async def on_voice_state_update(member: discord.Member, before:discord.VoiceStat
             selfcheck = True
         if  not mem.bot:
             allbot = False
-    if before.channel and allbot and selfcheck:
+    if allbot and selfcheck:
         client = member.guild.voice_client
         if client:
             # 自動退出時もキューをクリア
-            if member.guild.id in queue_dict:
-                queue_dict[member.guild.id].clear()
+            sessions.remove(member.guild.id)
             await client.disconnect()
             await before.channel.send('ボイスチャンネルからログアウトしました')
 
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    # ニックネームが変わったら覚えている名前を捨てる
+    # (GATEWAY_LEAN では届かないので、名前は TTL と発言時の上書きで更新される)
+    if before.display_name != after.display_name:
+        name_resolver.cache.invalidate(after.id, after.guild.id)
+
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    if before.display_name != after.display_name:
+        name_resolver.cache.invalidate(after.id)
+
+
 async def cleanup_voice_clients():
     """Clean up all voice client connections"""
     for voice_client in bot.voice_clients:
@@ -665,12 +1276,34 @@ async def cleanup_voice_clients():
 
 def cleanup_processes():
     """Clean up any remaining OpenJTalk processes on exit"""
+    # 常駐ワーカーへのジョブ投入を止めてから残ったプロセスを止める
+    synthesis_engine.close()
     with cleanup_lock:
         for process in list(active_processes):
+            # asyncio のプロセスは同期的に wait できないので terminate → kill で止める
             try:
-                if process.poll() is None:
+                if process.returncode is None:
                     process.terminate()
-                    process.wait(timeout=5)
+            except ProcessLookupError:
+                continue
+            except:
+                try:
+                    process.kill()
+                except:
+                    pass
+        deadline = time.monotonic() + 5
+        for process in list(active_processes):
+            try:
+                while process.returncode is None and time.monotonic() < deadline:
+                    pid, _ = os.waitpid(process.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    time.sleep(0.05)
+                else:
+                    if process.returncode is None:
+                        process.kill()
+            except ChildProcessError:
+                pass
             except:
                 try:
                     process.kill()
@@ -715,6 +1348,16 @@ async def main():
         print(f"Client ID: {client_id[:10]}..." if len(client_id) > 10 else "Client ID: [too short]")
         print(f"Application ID: {application_id}")
         print(f"Dictionary Channel ID: {dictID}")
+        if SHARD_COUNT or SHARD_IDS:
+            print(f"Shards: {SHARD_IDS or 'all'} of {SHARD_COUNT or 'auto'}")
+        # ループが動いている間は辞書を書き戻してログアウトしてから finally で片付ける
+        # (launcher.py から転送されたシグナルもここで受ける)
+        loop = asyncio.get_running_loop()
+        loop_monitor.install(loop)
+        if LOOP_MONITOR:
+            loop_monitor.start()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: asyncio.create_task(shutdown()))
         async with bot:
             await bot.start(client_id)
     except Exception as e:
@@ -725,6 +1368,8 @@ async def main():
     finally:
         await cleanup_voice_clients()
         cleanup_processes()
+        dict_store.close()
+        tracer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""In-memory audio helpers for playing synthesized speech without ffmpeg.
+
+合成した時点で一度だけ前後の無音を削って音量を揃え、サーバーごとの音量を掛けておく。
+Opus が使えるときはそこでエンコードもしておき、再生中はパケットをそのまま送る。
+再生は ClipStream 1つに続けてクリップを足していき、クリップごとに play() し直さない。
+"""
+import threading
+from collections import deque
+from typing import Callable
+
+import discord
+import numpy as np
+
+SAMPLING_RATE = discord.opus.Encoder.SAMPLING_RATE
+CHANNELS = discord.opus.Encoder.CHANNELS
+# 20ms 分の 48kHz ステレオ 16bit PCM
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+# これより長い合成結果(16bit モノラル PCM のバイト数)は再生しない
+MAX_PCM_BYTES = 10000000
+# これより小さい振幅は無音とみなして前後を削る(約 -40dBFS)
+SILENCE_THRESHOLD = 328
+# 削ったあとに前後に残す無音(秒)。クリップ間の間隔が揃う
+SILENCE_PADDING = 0.04
+# 音量を揃える目標の RMS(約 -20dBFS)と、超えないようにするピーク
+TARGET_RMS = 3277.0
+PEAK_LIMIT = 31000.0
+
+
+def trim_silence(samples: np.ndarray, rate: int) -> np.ndarray:
+    """Cut leading and trailing silence, keeping SILENCE_PADDING on both ends"""
+    loud = np.flatnonzero(np.abs(samples.astype(np.int32)) > SILENCE_THRESHOLD)
+    if not len(loud):
+        return samples[:0]
+    padding = int(rate * SILENCE_PADDING)
+    return samples[max(0, loud[0] - padding):loud[-1] + 1 + padding]
+
+
+def normalize(samples: np.ndarray, gain: float = 1.0) -> np.ndarray:
+    """Scale to TARGET_RMS times gain without letting peaks pass PEAK_LIMIT"""
+    if not len(samples):
+        return samples
+    values = samples.astype(np.float32)
+    rms = float(np.sqrt(np.mean(values * values)))
+    peak = float(np.max(np.abs(values)))
+    if rms == 0.0:
+        return samples
+    scale = min(TARGET_RMS / rms * gain, PEAK_LIMIT / peak)
+    return np.rint(values * scale).astype('<i2')
+
+
+def to_discord_pcm(samples: np.ndarray, rate: int) -> bytes:
+    """Convert 16bit mono samples to 48kHz stereo PCM, padded to whole 20ms frames"""
+    if rate != SAMPLING_RATE and len(samples):
+        n = int(round(len(samples) * SAMPLING_RATE / rate))
+        positions = np.arange(n) * (rate / SAMPLING_RATE)
+        samples = np.rint(np.interp(positions, np.arange(len(samples)), samples)).astype('<i2')
+    # L/R に同じサンプルを並べてステレオにする
+    stereo = np.repeat(samples, CHANNELS)
+    padding = -stereo.nbytes % FRAME_SIZE
+    return stereo.tobytes() + bytes(padding)
+
+
+def make_clip(pcm: bytes, rate: int, encoding: str = 'pcm', gain: float = 1.0) -> bytes:
+    """Turn synthesized 16bit mono PCM into a playable clip
+
+    Silence around the speech is trimmed and the loudness normalized, then
+    gain (the guild's volume) applied. encoding is 'pcm' for discord PCM or
+    'opus<kbps>' (e.g. 'opus64') for encode_opus() packets. CPU-bound, so
+    call it from a worker thread.
+    """
+    if len(pcm) > MAX_PCM_BYTES:
+        raise ValueError("再生時間が長すぎるよ")
+    # リサンプルする前のモノラルのうちに処理する
+    samples = normalize(trim_silence(np.frombuffer(pcm, dtype='<i2'), rate), gain)
+    clip = to_discord_pcm(samples, rate)
+    if encoding.startswith('opus'):
+        clip = encode_opus(clip, int(encoding[4:]))
+    return clip
+
+
+class PCMBufferSource(discord.AudioSource):
+    """AudioSource reading 20ms frames straight out of an in-memory PCM buffer"""
+
+    def __init__(self, pcm: bytes):
+        self._view = memoryview(pcm)
+        self._position = 0
+
+    def read(self) -> bytes:
+        position = self._position
+        if position >= len(self._view):
+            return b''
+        self._position = position + FRAME_SIZE
+        # opus エンコーダは bytes しか受け付けないのでフレーム単位でだけコピーする
+        return self._view[position:position + FRAME_SIZE].tobytes()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self._view.release()
+
+
+def encode_opus(pcm: bytes, bitrate: int = 64) -> bytes:
+    """Encode discord PCM (whole 20ms frames) to length-prefixed Opus packets
+
+    Blocks on libopus, so call it from a worker thread.
+    """
+    encoder = discord.opus.Encoder(application='voip', bitrate=bitrate, signal_type='voice')
+    view = memoryview(pcm)
+    packets = []
+    for position in range(0, len(view), FRAME_SIZE):
+        packet = encoder.encode(view[position:position + FRAME_SIZE].tobytes(), SAMPLES_PER_FRAME)
+        # 1パケットは 20ms 分なので 2 バイトの長さで足りる
+        packets.append(len(packet).to_bytes(2, 'big'))
+        packets.append(packet)
+    return b''.join(packets)
+
+
+class OpusBufferSource(discord.AudioSource):
+    """AudioSource passing pre-encoded packets from encode_opus() straight through"""
+
+    def __init__(self, clip: bytes):
+        self._view = memoryview(clip)
+        self._position = 0
+
+    def read(self) -> bytes:
+        position = self._position
+        if position + 2 > len(self._view):
+            return b''
+        size = int.from_bytes(self._view[position:position + 2], 'big')
+        self._position = position + 2 + size
+        return self._view[position + 2:self._position].tobytes()
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._view.release()
+
+
+class ClipStream(discord.AudioSource):
+    """One continuous AudioSource that plays queued clips back to back
+
+    Clips are added from the event loop while the voice thread reads frames.
+    When the queue runs dry the stream sends silence for up to linger frames
+    so a clip added in that time continues the same play() call; after that
+    the stream ends and add() returns False.
+    """
+
+    def __init__(self, opus: bool, linger: int = 10):
+        self._opus = opus
+        self._silence = discord.opus.OPUS_SILENCE if opus else bytes(FRAME_SIZE)
+        self.linger = linger
+        self._clips: deque[tuple[discord.AudioSource, Callable[[], None]]] = deque()
+        self._lock = threading.Lock()
+        self._current: discord.AudioSource | None = None
+        self._on_end: Callable[[], None] | None = None
+        # 次に渡すフレーム(1つ先まで読んでおき、クリップの最後のフレームが分かるようにする)
+        self._frame: bytes | None = None
+        self._idle = 0
+        self._closed = False
+
+    def add(self, source: discord.AudioSource, on_end: Callable[[], None]) -> bool:
+        """Queue source; on_end is called from the voice thread once its last frame is read"""
+        with self._lock:
+            if self._closed:
+                return False
+            self._clips.append((source, on_end))
+            return True
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self._frame is None and not self._start_next():
+                if self._idle >= self.linger:
+                    self._closed = True
+                    return b''
+                self._idle += 1
+                return self._silence
+            frame = self._frame
+            self._frame = self._current.read() or None
+            if self._frame is None:
+                # 最後のフレームを渡した時点で終わったことにして、次のクリップを足す時間を作る
+                self._finish_current()
+            return frame
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            self._frame = None
+            if self._current is not None:
+                self._finish_current()
+            while self._clips:
+                self._current, self._on_end = self._clips.popleft()
+                self._finish_current()
+
+    def _start_next(self) -> bool:
+        while self._clips:
+            self._current, self._on_end = self._clips.popleft()
+            self._frame = self._current.read() or None
+            if self._frame is not None:
+                self._idle = 0
+                return True
+            self._finish_current()
+        return False
+
+    def _finish_current(self):
+        source, on_end = self._current, self._on_end
+        self._current = self._on_end = None
+        source.cleanup()
+        on_end()
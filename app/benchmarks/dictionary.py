@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of per-message reading dictionary cost.
+
+app/ で `python -m benchmarks.dictionary` を実行すると、辞書の件数を増やしながら
+以前の行ごとの置換とトライ木での置換の1メッセージあたりの時間を比べる。
+"""
+import argparse
+import random
+import timeit
+
+from dictionary import ReadingDictionary
+
+KANA = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'
+KANJI = '草今日明日天気予定会議資料確認東京大阪電車遅延連絡'
+KATAKANA = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヲン'
+
+
+def legacy_replace(content: str, text: str) -> str:
+    """The previous replaceDict(): parse the message and replace entry by entry"""
+    lines = content.splitlines()
+    for line in lines:
+        pattern = line.strip().split(',')
+        if pattern[0] in text and len(pattern) >= 2:
+            text = text.replace(pattern[0], pattern[1])
+    return text
+
+
+def make_content(size: int, rng: random.Random) -> str:
+    lines = ['文字列,文字列']
+    for _ in range(size):
+        # 読みはカタカナにして、置換結果に別の単語が一致し続けないようにする
+        word = ''.join(rng.choice(KANJI + KANA) for _ in range(rng.randint(2, 10)))
+        reading = ''.join(rng.choice(KATAKANA) for _ in range(rng.randint(1, 10)))
+        lines.append(f'{word},{reading}')
+    return '\n'.join(lines)
+
+
+def make_message(rng: random.Random, length: int) -> str:
+    return ''.join(rng.choice(KANJI + KANA) for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='10,100,1000,5000')
+    parser.add_argument('--length', type=int, default=150, help='characters per message')
+    parser.add_argument('--number', type=int, default=200, help='messages per measurement')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    messages = [make_message(rng, args.length) for _ in range(50)]
+    print(f"{'entries':>8} {'legacy us/msg':>14} {'trie us/msg':>12} {'compile ms':>11}")
+    for size in map(int, args.sizes.split(',')):
+        content = make_content(size, rng)
+        compile_time = timeit.timeit(lambda: ReadingDictionary().load(content), number=5) / 5
+        reading_dict = ReadingDictionary()
+        reading_dict.load(content)
+
+        def run_legacy():
+            for message in messages:
+                legacy_replace(content, message)
+
+        def run_trie():
+            for message in messages:
+                reading_dict.replace(message)
+
+        rounds = max(1, args.number // len(messages))
+        legacy = min(timeit.repeat(run_legacy, number=rounds, repeat=3)) / (rounds * len(messages))
+        trie = min(timeit.repeat(run_trie, number=rounds, repeat=3)) / (rounds * len(messages))
+        print(f"{size:>8} {legacy * 1e6:>14.1f} {trie * 1e6:>12.1f} {compile_time * 1e3:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
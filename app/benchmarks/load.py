@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+"""Offline load test of the bot's event handlers with a fake gateway and synthesizer.
+
+app/ で `python -m benchmarks.load` を実行すると、Discord に接続せずに app.py の
+on_message・on_voice_state_update と /join・/dc を偽のサーバー・チャンネル・メンバーに
+対して呼び、合成は指定した時間だけ待って単純な音を返すものに差し替える。
+偽の VoiceClient は本物と同じく別スレッドで 20ms ごとにフレームを読むので、
+再生の詰まりや隙間は実時間で現れる。シナリオごとに読み上げた件数(件/秒)、
+受信から最初の音までの時間、クリップ間の無音、RSS を表にする。
+gateway シナリオは GATEWAY_LEAN の有無で discord.py のキャッシュに同じサーバーを
+詰めたときの確保量を比べ、1000サーバーあたりの差を表の下に出す。
+
+    python -m benchmarks.load --scenarios burst,steady,idle --synth-latency 0.2
+"""
+import argparse
+import asyncio
+import atexit
+import contextlib
+import itertools
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import discord
+import numpy as np
+
+# 20ms ごとに1フレーム
+FRAME_SECONDS = 0.02
+ids = itertools.count(10 ** 17)
+
+
+class Recorder:
+    """Stands in for a metrics histogram and keeps every observed value"""
+
+    def __init__(self):
+        self.values: list[float] = []
+
+    def observe(self, value: float):
+        self.values.append(value)
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def milliseconds(seconds: float | None) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.0f}ms'
+
+
+class StubSynthesizer:
+    """Synthesis engine that waits instead of running OpenJTalk and returns a tone"""
+
+    def __init__(self, latency: float, per_char: float, speech_rate: float, rate: int = 48000):
+        self.latency = latency
+        self.per_char = per_char
+        # 1秒あたりに読む文字数(返す音声の長さ)
+        self.speech_rate = speech_rate
+        self.rate = rate
+        self.requests = 0
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def synthesize(self, text: str, params=None) -> tuple[bytes, int]:
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.per_char * len(text))
+        # OpenJTalk と同じように前後に無音の付いた音を返す
+        tone = np.sin(np.arange(int(len(text) / self.speech_rate * self.rate)) * (2 * np.pi * 440 / self.rate))
+        silence = np.zeros(int(self.rate * 0.2))
+        return (np.concatenate((silence, tone, silence)) * 8000).astype('<i2').tobytes(), self.rate
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False, guild=None):
+        self.id = next(ids)
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.guild = guild
+        self.voice: FakeVoiceState | None = None
+        self.mention = f'<@{self.id}>'
+
+
+class FakeTextChannel:
+    def __init__(self, guild, name: str):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+        self.sent: list[str] = []
+
+    async def send(self, content: str = '', **kwargs):
+        self.sent.append(content)
+
+
+class FakeVoiceClient:
+    """Consumes an AudioSource in real time on its own thread, like discord's AudioPlayer"""
+
+    def __init__(self, channel: 'FakeVoiceChannel'):
+        self.channel = channel
+        self.guild = channel.guild
+        self.latency = 0.0
+        self.removed = False
+        self._connected = True
+        self._stop: threading.Event | None = None
+        self._thread: threading.Thread | None = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise RuntimeError('Already playing audio.')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._consume, args=(source, after, self._stop), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    async def move_to(self, channel: 'FakeVoiceChannel', **kwargs):
+        await asyncio.sleep(channel.connect_latency)
+        self.channel.members = [member for member in self.channel.members if member.id != self.guild.bot_member.id]
+        channel.members.append(self.guild.bot_member)
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+        self.channel.members = [member for member in self.channel.members if member.id != self.guild.bot_member.id]
+        self.guild.voice_client = None
+
+    @staticmethod
+    def _consume(source, after, stop: threading.Event):
+        error = None
+        start = time.perf_counter()
+        try:
+            for frames in itertools.count(1):
+                if stop.is_set() or not source.read():
+                    break
+                # 遅れても次のフレームの予定時刻に合わせる(本物の送信スレッドと同じ)
+                delay = start + FRAME_SECONDS * frames - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+        if after is not None:
+            after(error)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, name: str, connect_latency: float):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+        self.members: list[FakeUser] = []
+        self.connect_latency = connect_latency
+
+    async def connect(self, *, timeout: float = 60.0, reconnect: bool = True, **kwargs) -> FakeVoiceClient:
+        await asyncio.sleep(self.connect_latency)
+        client = FakeVoiceClient(self)
+        self.members.append(self.guild.bot_member)
+        self.guild.voice_client = client
+        return client
+
+    async def send(self, content: str = '', **kwargs):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, index: int, bot_user: FakeUser, members: int, connect_latency: float):
+        self.id = next(ids)
+        self.name = f'guild-{index}'
+        self.voice_client: FakeVoiceClient | None = None
+        self.bot_member = FakeUser(bot_user.name, bot=True, guild=self)
+        self.bot_member.id = bot_user.id
+        self.text_channel = FakeTextChannel(self, 'general')
+        self.voice_channel = FakeVoiceChannel(self, 'voice', connect_latency)
+        self.members = [FakeUser(f'user{index}-{i}', guild=self) for i in range(members)]
+        self._members = {member.id: member for member in self.members}
+
+    def get_member(self, user_id: int) -> FakeUser | None:
+        return self._members.get(user_id)
+
+    def get_role(self, role_id: int):
+        return None
+
+    def get_channel_or_thread(self, channel_id: int):
+        return None
+
+    async def query_members(self, *, user_ids=None, **kwargs) -> list[FakeUser]:
+        return [self._members[user_id] for user_id in user_ids or () if user_id in self._members]
+
+    def enter_voice(self, member: FakeUser) -> tuple[FakeVoiceState, FakeVoiceState]:
+        """Move member into the voice channel; returns (before, after) for on_voice_state_update"""
+        member.voice = FakeVoiceState(self.voice_channel)
+        self.voice_channel.members.append(member)
+        return FakeVoiceState(None), member.voice
+
+    def leave_voice(self, member: FakeUser) -> tuple[FakeVoiceState, FakeVoiceState]:
+        self.voice_channel.members.remove(member)
+        member.voice = None
+        return FakeVoiceState(self.voice_channel), FakeVoiceState(None)
+
+
+class FakeMessage:
+    def __init__(self, guild: FakeGuild, author: FakeUser, content: str):
+        self.id = next(ids)
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = author
+        self.content = content
+        self.mentions = []
+        self.attachments = []
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, content: str = '', **kwargs):
+        pass
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent: list[str] = []
+
+    async def send(self, content: str = '', **kwargs):
+        self.sent.append(content)
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeUser):
+        self.guild = guild
+        self.user = user
+        self.channel = guild.text_channel
+        self.channel_id = guild.text_channel.id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+class Harness:
+    """Drives app.py's handlers against fake guilds"""
+
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.bot_user = FakeUser('tts-bot', bot=True)
+        # bot.user は接続時に入るので、偽のユーザーを入れておく
+        app.bot._connection.user = self.bot_user
+        # 偽のメッセージはコマンドとして解釈できないので、プレフィックスのコマンド処理は飛ばす
+        app.bot.process_commands = self._no_commands
+        self.guilds: list[FakeGuild] = []
+        self.latency = Recorder()
+        self.gaps = Recorder()
+        # 記録先を差し替える(セッションを作る前に行う)
+        app.message_latency = self.latency
+        app.playback_gap = self.gaps
+
+    @staticmethod
+    async def _no_commands(message):
+        pass
+
+    def make_guilds(self, count: int) -> list[FakeGuild]:
+        guilds = [FakeGuild(len(self.guilds) + i, self.bot_user, self.args.members, self.args.connect_latency)
+                  for i in range(count)]
+        self.guilds.extend(guilds)
+        return guilds
+
+    async def join(self, guild: FakeGuild):
+        """/join by the guild's first member"""
+        member = guild.members[0]
+        before, after = guild.enter_voice(member)
+        await self.app.join.callback(FakeInteraction(guild, member))
+        await self.app.on_voice_state_update(member, before, after)
+
+    async def dc(self, guild: FakeGuild):
+        await self.app.dc.callback(FakeInteraction(guild, guild.members[0]))
+
+    async def send(self, guild: FakeGuild, author: FakeUser, content: str):
+        await self.app.on_message(FakeMessage(guild, author, content))
+
+    async def voice_event(self, guild: FakeGuild, member: FakeUser):
+        """Toggle member in and out of the voice channel"""
+        if member.voice is None:
+            before, after = guild.enter_voice(member)
+        else:
+            before, after = guild.leave_voice(member)
+        await self.app.on_voice_state_update(member, before, after)
+
+    async def drain(self, guilds: list[FakeGuild], timeout: float):
+        """Wait until every guild has read its queue and stopped playing"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            busy = False
+            for guild in guilds:
+                session = self.app.sessions.get(guild.id)
+                if session is not None and (len(session.pipeline) or guild.voice_client.is_playing()):
+                    busy = True
+                    break
+            if not busy:
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+
+def message_text(n: int, length: int) -> str:
+    body = 'きょうのよていをかくにんしてください。あしたのかいぎはじゅうじからです。'
+    return f'{n}番目、' + (body * (length // len(body) + 1))[:length]
+
+
+async def scenario_burst(harness: Harness, args) -> dict:
+    """One guild receiving a burst of messages from all of its members"""
+    guild, = harness.make_guilds(1)
+    await harness.join(guild)
+    started = time.monotonic()
+    for n in range(args.messages):
+        await harness.send(guild, guild.members[n % len(guild.members)], message_text(n, args.length))
+    drained = await harness.drain([guild], args.timeout)
+    elapsed = time.monotonic() - started
+    await harness.dc(guild)
+    return dict(guilds=1, sent=args.messages, elapsed=elapsed, drained=drained)
+
+
+async def scenario_steady(harness: Harness, args) -> dict:
+    """Several guilds chatting at a steady rate while members come and go"""
+    guilds = harness.make_guilds(args.guilds)
+    for guild in guilds:
+        await harness.join(guild)
+    started = time.monotonic()
+    sent = 0
+    interval = 1 / args.rate
+    for tick in range(int(args.duration * args.rate)):
+        tick_start = time.monotonic()
+        for guild in guilds:
+            await harness.send(guild, guild.members[tick % len(guild.members)], message_text(tick, args.length))
+            sent += 1
+            # 5秒に1回くらい誰かが出入りする
+            if tick % max(1, int(5 * args.rate)) == 0:
+                await harness.voice_event(guild, guild.members[-1])
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - tick_start)))
+    drained = await harness.drain(guilds, args.timeout)
+    elapsed = time.monotonic() - started
+    for guild in guilds:
+        await harness.dc(guild)
+    return dict(guilds=len(guilds), sent=sent, elapsed=elapsed, drained=drained)
+
+
+async def scenario_idle(harness: Harness, args) -> dict:
+    """Many connected guilds with nothing to read: connection cost and memory per guild"""
+    guilds = harness.make_guilds(args.idle_guilds)
+    started = time.monotonic()
+    await asyncio.gather(*(harness.join(guild) for guild in guilds))
+    # 挨拶の読み上げが終わるまで待ってから測る
+    drained = await harness.drain(guilds, args.timeout)
+    elapsed = time.monotonic() - started
+    rss = harness.app.rss_bytes()
+    for guild in guilds:
+        await harness.dc(guild)
+    return dict(guilds=len(guilds), sent=0, elapsed=elapsed, drained=drained, rss=rss)
+
+
+def guild_payload(guild_id: int, members: int, in_voice: int) -> dict:
+    """GUILD_CREATE payload with a text and a voice channel, as if chunked"""
+    text_id, voice_id = next(ids), next(ids)
+    users = [next(ids) for _ in range(members)]
+    return {
+        'id': str(guild_id), 'name': f'guild-{guild_id}', 'owner_id': str(users[0]), 'member_count': members,
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0,
+                   'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [
+            {'id': str(text_id), 'type': 0, 'name': 'general', 'position': 0, 'permission_overwrites': []},
+            {'id': str(voice_id), 'type': 2, 'name': 'voice', 'position': 1, 'permission_overwrites': [],
+             'bitrate': 64000, 'user_limit': 0},
+        ],
+        'members': [{'user': {'id': str(user), 'username': f'user{user}', 'discriminator': '0',
+                              'avatar': None, 'global_name': f'ユーザー{n}'},
+                     'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False,
+                     'flags': 0}
+                    for n, user in enumerate(users)],
+        'voice_states': [{'user_id': str(user), 'channel_id': str(voice_id), 'session_id': 'benchmark',
+                          'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False,
+                          'self_video': False, 'suppress': False, 'request_to_speak_timestamp': None}
+                         for user in users[:in_voice]],
+        'emojis': [], 'stickers': [], 'features': [], 'presences': [], 'threads': [],
+    }
+
+
+def message_payload(guild: dict, n: int) -> dict:
+    member = guild['members'][n % len(guild['members'])]
+    return {
+        'id': str(next(ids)), 'channel_id': guild['channels'][0]['id'], 'guild_id': guild['id'], 'type': 0,
+        'author': member['user'], 'member': {key: value for key, value in member.items() if key != 'user'},
+        'content': message_text(n, 20), 'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None,
+        'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [],
+        'embeds': [], 'pinned': False,
+    }
+
+
+async def scenario_gateway(harness: Harness, args) -> dict:
+    """The same guilds and messages in discord.py's caches with the full and the lean gateway options"""
+    app = harness.app
+    started = time.monotonic()
+    allocated = {}
+    for lean in (False, True):
+        app.GATEWAY_LEAN = lean
+        state = discord.Client(**app.gateway_options())._connection
+        # Python が確保した量だけを数え、インタプリタや numpy などの固定分は入れない
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(args.idle_guilds):
+            guild = guild_payload(next(ids), args.cached_members, args.members)
+            state._add_guild_from_data(guild)
+            for n in range(args.cached_messages):
+                state.parse_message_create(message_payload(guild, n))
+        allocated[lean] = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        state.clear()
+    app.GATEWAY_LEAN = os.environ.get('GATEWAY_LEAN', '1') != '0'
+    full, lean = (allocated[mode] / 1024 / 1024 / args.idle_guilds * 1000 for mode in (False, True))
+    notes = [f"gateway: discord.py のキャッシュ 1000サーバーあたり full {full:.1f}MB, lean {lean:.1f}MB "
+             f"(差 {full - lean:.1f}MB, メンバー {args.cached_members}人・うちボイス {args.members}人・"
+             f"メッセージ {args.cached_messages}件/サーバー)"]
+    return dict(guilds=args.idle_guilds, sent=0, elapsed=time.monotonic() - started, drained=True, notes=notes)
+
+
+SCENARIOS = {
+    'burst': scenario_burst,
+    'steady': scenario_steady,
+    'idle': scenario_idle,
+    'gateway': scenario_gateway,
+}
+
+
+def configure_environment(args):
+    """Environment for importing app.py without a bot token, Discord or OpenJTalk"""
+    os.environ.setdefault('DICT_CH_ID', '1')
+    os.environ.setdefault('DISCORD_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('DISCORD_APP_ID', '1')
+    os.environ['DICT_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='tts-bench-'), 'dictionary.sqlite3')
+    os.environ['METRICS_PORT'] = '0'
+    os.environ.pop('TTS_SERVER', None)
+    os.environ.pop('TTS_CACHE_DIR', None)
+    os.environ.pop('SHARD_IDS', None)
+    if args.workers:
+        os.environ['SYNTH_CONCURRENCY'] = str(args.workers)
+
+
+async def run(args):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        import app
+        # 終了時の後始末は本物のボイス接続と合成プロセス向けなので外し、Ctrl+C で止まるようにする
+        atexit.unregister(app.cleanup_all)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        app.synthesis_engine = StubSynthesizer(args.synth_latency, args.synth_per_char, args.speech_rate)
+        app.loop_monitor.install(asyncio.get_running_loop())
+        harness = Harness(app, args)
+
+    print(f"{'scenario':>8} {'guilds':>6} {'sent':>5} {'read':>5} {'secs':>6} {'msg/s':>6} "
+          f"{'lat p50':>8} {'p95':>7} {'p99':>7} {'gap p50':>8} {'p95':>7} {'max':>7} "
+          f"{'dropped':>7} {'RSS MB':>7}")
+    notes = []
+    for name in args.scenarios.split(','):
+        latency_start, gap_start = len(harness.latency.values), len(harness.gaps.values)
+        rejected_start = sum(app.admission.rejected.values())
+        backlog_start = app.sessions.backlog_totals()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            result = await SCENARIOS[name](harness, args)
+        latency = harness.latency.values[latency_start:]
+        gaps = harness.gaps.values[gap_start:]
+        backlog = app.sessions.backlog_totals()
+        # 読まなかった件数(連投で弾いた・溜まりすぎて捨てた・古くなった)
+        dropped = (sum(app.admission.rejected.values()) - rejected_start
+                   + backlog.dropped - backlog_start.dropped + backlog.stale - backlog_start.stale)
+        rss = result.get('rss', app.rss_bytes()) / 1024 / 1024
+        read = len(latency)
+        columns = [
+            milliseconds(percentile(latency, 0.5)), milliseconds(percentile(latency, 0.95)),
+            milliseconds(percentile(latency, 0.99)), milliseconds(percentile(gaps, 0.5)),
+            milliseconds(percentile(gaps, 0.95)), milliseconds(max(gaps, default=None)),
+        ]
+        print(f"{name:>8} {result['guilds']:>6} {result['sent']:>5} {read:>5} {result['elapsed']:>6.1f} "
+              f"{read / result['elapsed']:>6.1f} {columns[0]:>8} {columns[1]:>7} {columns[2]:>7} "
+              f"{columns[3]:>8} {columns[4]:>7} {columns[5]:>7} {dropped:>7} {rss:>7.1f}"
+              + ('' if result['drained'] else '  (timed out)'))
+        notes += result.get('notes', [])
+    for note in notes:
+        print(note)
+    if args.stages:
+        print()
+        for guild in harness.guilds[:args.stages]:
+            stages = app.tracer.summary(guild.id)
+            if stages:
+                print(f"{guild.name}: " + ", ".join(
+                    f"{stage} {p50:.0f}/{p95:.0f}ms" for stage, (p50, p95, _) in stages.items()))
+    app.dict_store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='burst,steady,idle', help=f"comma separated: {', '.join(SCENARIOS)}")
+    parser.add_argument('--messages', type=int, default=60, help='messages in the burst scenario')
+    parser.add_argument('--guilds', type=int, default=20, help='guilds in the steady scenario')
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per second per guild (steady)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of traffic (steady)')
+    parser.add_argument('--idle-guilds', type=int, default=500, help='guilds in the idle scenario')
+    parser.add_argument('--members', type=int, default=10, help='members per guild')
+    parser.add_argument('--cached-members', type=int, default=100, help='members per guild in the gateway scenario')
+    parser.add_argument('--cached-messages', type=int, default=20, help='messages per guild in the gateway scenario')
+    parser.add_argument('--length', type=int, default=20, help='characters per message')
+    parser.add_argument('--synth-latency', type=float, default=0.15, help='seconds per synthesis')
+    parser.add_argument('--synth-per-char', type=float, default=0.002, help='extra seconds per character')
+    parser.add_argument('--speech-rate', type=float, default=8, help='characters read per second of audio')
+    parser.add_argument('--connect-latency', type=float, default=0.1, help='seconds to join a voice channel')
+    parser.add_argument('--workers', type=int, default=0, help='synthesis concurrency (SYNTH_CONCURRENCY)')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for queues to drain')
+    parser.add_argument('--stages', type=int, default=0, help='print per-stage latency for the first N guilds')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own log output")
+    args = parser.parse_args()
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    configure_environment(args)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Reading dictionary compiled into a trie.
+
+辞書は「置換前,置換後」の行の並び。メッセージごとに解析し直さず、変更があったときだけ
+トライ木を作り直す。置換は1回の走査で、同じ位置では最も長く一致した単語を優先する。
+辞書の正本はローカルの SQLite に置き、Discord のメッセージへはまとめて書き戻す。
+"""
+import re
+import sqlite3
+import threading
+
+# トライ木の各ノードで置換後の文字列を持つキー
+_END = ''
+# 辞書メッセージの先頭行。ここから辞書が始まる目印にもなる
+HEADER = '文字列,文字列'
+# Discord のメッセージの文字数上限
+MESSAGE_LIMIT = 2000
+
+
+def parse_entries(content: str) -> list[tuple[str, str]]:
+    entries = []
+    for line in content.splitlines():
+        if line.strip() == HEADER:
+            continue
+        pattern = line.strip().split(',')
+        if len(pattern) >= 2 and pattern[0]:
+            entries.append((pattern[0], pattern[1]))
+    return entries
+
+
+def render_messages(entries: list[tuple[str, str]]) -> list[str]:
+    """Lay out entries as dictionary message contents within the message limit"""
+    messages = []
+    current = HEADER
+    for word, reading in entries:
+        line = f'{word},{reading}'
+        if len(current) + 1 + len(line) > MESSAGE_LIMIT:
+            messages.append(current)
+            current = line
+        else:
+            current += '\n' + line
+    messages.append(current)
+    return messages
+
+
+class ReadingDictionary:
+    """Single-pass, longest-match-first replacement over a compiled trie"""
+
+    def __init__(self, entries: list[tuple[str, str]] | None = None):
+        self._root: dict = {}
+        self.compile(entries or [])
+
+    def __len__(self) -> int:
+        return self._size
+
+    def load(self, content: str):
+        self.compile(parse_entries(content))
+
+    def compile(self, entries: list[tuple[str, str]]):
+        root: dict = {}
+        size = 0
+        for word, reading in entries:
+            node = root
+            for ch in word:
+                node = node.setdefault(ch, {})
+            # 同じ単語が複数あるときは先に登録されたものを使う
+            if _END not in node:
+                node[_END] = reading
+                size += 1
+        self._root = root
+        self._size = size
+        # 単語の先頭になりうる文字まで正規表現で読み飛ばす
+        self._starts = re.compile('[' + ''.join(re.escape(ch) for ch in root) + ']') if root else None
+
+    def replace(self, text: str) -> str:
+        root = self._root
+        starts = self._starts
+        if starts is None:
+            return text
+        output = []
+        i = 0
+        n = len(text)
+        while i < n:
+            found = starts.search(text, i)
+            if found is None:
+                output.append(text[i:])
+                break
+            start = found.start()
+            if start > i:
+                output.append(text[i:start])
+                i = start
+            node = root[text[i]]
+            match_end = -1
+            reading = None
+            j = i + 1
+            while True:
+                if _END in node:
+                    match_end, reading = j, node[_END]
+                if j >= n:
+                    break
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+            if reading is None:
+                output.append(text[i])
+                i += 1
+            else:
+                output.append(reading)
+                i = match_end
+        return ''.join(output)
+
+
+class DictionaryStore:
+    """SQLite-backed reading dictionary with a compiled in-memory index"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, word TEXT NOT NULL, reading TEXT NOT NULL)')
+        self._db.commit()
+        self._lock = threading.Lock()
+        self.entries: list[tuple[int, str, str]] = self._db.execute(
+            'SELECT id, word, reading FROM entries ORDER BY id').fetchall()
+        self.index = ReadingDictionary(self.pairs())
+        # 変更のたびに増える。書き戻し済みかどうかの判定に使う
+        self.version = 0
+        self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def pairs(self) -> list[tuple[str, str]]:
+        return [(word, reading) for _, word, reading in self.entries]
+
+    def replace(self, text: str) -> str:
+        return self.index.replace(text)
+
+    def add(self, word: str, reading: str):
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO entries (word, reading) VALUES (?, ?)', (word, reading))
+            self._db.commit()
+            self.entries = self.entries + [(cursor.lastrowid, word, reading)]
+            self._changed()
+
+    def remove(self, num: int) -> bool:
+        """Remove the num-th entry (1-based, as listed by /get)"""
+        with self._lock:
+            if not 1 <= num <= len(self.entries):
+                return False
+            entry_id = self.entries[num - 1][0]
+            self._db.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+            self._db.commit()
+            self.entries = self.entries[:num - 1] + self.entries[num:]
+            self._changed()
+            return True
+
+    def import_entries(self, entries: list[tuple[str, str]]):
+        """Replace every entry, e.g. when importing the dictionary from Discord"""
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM entries')
+                self._db.executemany('INSERT INTO entries (word, reading) VALUES (?, ?)', entries)
+            self.entries = self._db.execute('SELECT id, word, reading FROM entries ORDER BY id').fetchall()
+            self._changed()
+
+    def refresh(self) -> bool:
+        """Reload entries if another process changed the database; return True if it did"""
+        with self._lock:
+            # data_version は他の接続がコミットしたときだけ変わる
+            data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+            self.entries = self._db.execute('SELECT id, word, reading FROM entries ORDER BY id').fetchall()
+            self._changed()
+            return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _changed(self):
+        self.index = ReadingDictionary(self.pairs())
+        self.version += 1
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Run the bot as several shard processes.
+
+`python launcher.py --processes 4 --shards 8` で app.py を4プロセス起動し、8つのシャードを
+順番に割り振る。サーバーごとの状態は担当シャードのプロセスだけが持ち、辞書(SQLite)と
+ディスクの音声キャッシュ(TTS_CACHE_DIR)はプロセス間で共有する。
+
+SIGTERM / SIGINT は子プロセスに転送するので、それぞれの cleanup_all() で後片付けされる。
+異常終了したプロセスは少し待ってから起動し直す。/bye などで正常に終わったプロセスは
+起動し直さず、全部終わったら launcher も終わる。
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+
+def shard_env(index: int, processes: int, shards: int, workers: int) -> dict[str, str]:
+    env = dict(os.environ)
+    env['SHARD_COUNT'] = str(shards)
+    env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in range(index, shards, processes))
+    # 合成ワーカーはコア数をプロセスで分け合う
+    env.setdefault('TTS_WORKERS', str(workers))
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run app.py as several shard processes')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('SHARD_PROCESSES', '2')))
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('SHARD_COUNT', '0') or 0),
+                        help='total number of shards (default: one per process)')
+    parser.add_argument('--restart-delay', type=float, default=5.0)
+    parser.add_argument('--stop-timeout', type=float, default=15.0)
+    args = parser.parse_args()
+
+    processes = max(1, args.processes)
+    shards = max(processes, args.shards)
+    workers = max(1, (os.cpu_count() or 1) // processes)
+    children: dict[int, subprocess.Popen] = dict()
+    stopping = False
+
+    def spawn(index: int):
+        env = shard_env(index, processes, shards, workers)
+        print(f"Starting shard process {index} (shards {env['SHARD_IDS']} of {shards})")
+        children[index] = subprocess.Popen([sys.executable, '-u', APP], env=env, cwd=os.path.dirname(APP))
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            if child.poll() is None:
+                child.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(processes):
+        spawn(index)
+
+    while not stopping and children:
+        time.sleep(1)
+        for index, child in list(children.items()):
+            if stopping or child.poll() is None:
+                continue
+            print(f"Shard process {index} exited with {child.returncode}")
+            if child.returncode == 0:
+                # 自分から終わったものは止めたままにする
+                del children[index]
+                continue
+            time.sleep(args.restart_delay)
+            if not stopping:
+                spawn(index)
+
+    deadline = time.monotonic() + args.stop_timeout
+    for index, child in children.items():
+        try:
+            child.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"Shard process {index} did not stop, killing it")
+            child.kill()
+            child.wait()
+    print("All shard processes stopped")
+
+
+if __name__ == '__main__':
+    main()
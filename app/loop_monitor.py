@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Event-loop lag monitor and slow-callback profiler.
+
+ループ上で一定間隔で眠るタスクを回し、予定より遅れて起きた分をラグとして記録する。
+別スレッドの見張りは、そのタスクがしきい値より長く起きてこなければループが
+止まっているとみなし、その時点のループのスレッドのスタックを出力する
+(止めている処理の途中のスタックが取れる)。
+to_thread / run_in_executor でループの外に出した処理は件数と時間を数える。
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """Default executor that counts the work moved off the event loop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.jobs += 1
+                    self.busy_seconds += elapsed
+        return super().submit(run)
+
+
+class LoopMonitor:
+    """Measures scheduling lag and dumps the stack of callbacks that stall the loop"""
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, on_lag=None):
+        self.interval = interval
+        # これより長くループが止まったら遅いコールバックとしてスタックを出す
+        self.threshold = threshold
+        # ラグ(秒)を受け取る。メトリクスのヒストグラムなど
+        self.on_lag = on_lag
+        self.executor = CountingExecutor(thread_name_prefix='offloop')
+        self.lags: deque[float] = deque(maxlen=1200)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._task: asyncio.Task | None = None
+        self._stopped = threading.Event()
+        self._loop_thread: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def install(self, loop: asyncio.AbstractEventLoop):
+        """Count off-loop work; cheap enough to leave on while the monitor is off"""
+        loop.set_default_executor(self.executor)
+
+    def start(self):
+        if self.enabled:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._stopped = threading.Event()
+        threading.Thread(target=self._watch, args=(self._stopped,), name='loop-watchdog', daemon=True).start()
+        print(f"Loop monitor started (interval {self.interval * 1000:.0f}ms, threshold {self.threshold * 1000:.0f}ms)")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._stopped.set()
+        print("Loop monitor stopped")
+
+    def summary(self) -> str:
+        lags = sorted(self.lags)
+        if not lags:
+            lag = "-"
+        else:
+            p50 = lags[len(lags) // 2] * 1000
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000
+            lag = f"p50 {p50:.1f}ms / p99 {p99:.1f}ms / 最大 {self.max_lag * 1000:.0f}ms"
+        return (
+            f"ループの遅れ: {lag} (停止 {self.stalls}回), "
+            f"ループ外の処理: {self.executor.jobs}件 {self.executor.busy_seconds:.1f}秒"
+        )
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            self.lags.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if self.on_lag is not None:
+                self.on_lag(lag)
+
+    def _watch(self, stopped: threading.Event):
+        reported = None
+        while not stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or heartbeat == reported:
+                continue
+            # 同じ停止は1回だけ出す
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(no frame)\n'
+            sys.stderr.write(f"Event loop blocked for {stalled * 1000:.0f}ms+, loop thread stack:\n{stack}")
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Name lookups for mentions without a REST call per mention.
+
+メンバーキャッシュにいない人の名前は TTL 付きの LRU に覚えておき、取得が必要な分は
+メッセージ単位でまとめて、同じ人への問い合わせは1回にまとめる。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class NameCache:
+    """Bounded LRU of display names with a time-to-live"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple[int, int], tuple[float, str]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, guild_id: int, user_id: int) -> str | None:
+        entry = self._entries.get((guild_id, user_id))
+        if entry is None:
+            return None
+        expires, name = entry
+        if expires < time.monotonic():
+            del self._entries[(guild_id, user_id)]
+            return None
+        self._entries.move_to_end((guild_id, user_id))
+        return name
+
+    def put(self, guild_id: int, user_id: int, name: str):
+        self._entries[(guild_id, user_id)] = (time.monotonic() + self.ttl, name)
+        self._entries.move_to_end((guild_id, user_id))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, guild_id: int | None = None):
+        """Forget a user's name in one guild, or in every guild when guild_id is None"""
+        if guild_id is not None:
+            self._entries.pop((guild_id, user_id), None)
+            return
+        for key in [key for key in self._entries if key[1] == user_id]:
+            del self._entries[key]
+
+
+class NameResolver:
+    """Resolve user display names: member cache, then NameCache, then batched REST"""
+
+    def __init__(self, client: discord.Client, cache: NameCache):
+        self.client = client
+        self.cache = cache
+        self.fetches = 0
+        self._pending: dict[tuple[int, int], asyncio.Future] = dict()
+
+    def remember(self, member: discord.Member | discord.User):
+        """Note a name seen in an event, for when members are not cached"""
+        guild = getattr(member, 'guild', None)
+        if guild is not None and guild.get_member(member.id) is None:
+            self.cache.put(guild.id, member.id, member.display_name)
+
+    def cached(self, guild: discord.Guild, user_id: int) -> str | None:
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member.display_name
+        return self.cache.get(guild.id, user_id)
+
+    async def resolve(self, guild: discord.Guild, user_ids: set[int]) -> dict[int, str]:
+        """Return display names for user_ids, fetching the unknown ones together"""
+        names = {}
+        missing = []
+        waiting = {}
+        for user_id in user_ids:
+            name = self.cached(guild, user_id)
+            if name is not None:
+                names[user_id] = name
+            elif (guild.id, user_id) in self._pending:
+                # 他のメッセージで取得中ならそれを待つ
+                waiting[user_id] = self._pending[(guild.id, user_id)]
+            else:
+                missing.append(user_id)
+        if missing:
+            futures = {}
+            loop = asyncio.get_running_loop()
+            for user_id in missing:
+                futures[user_id] = self._pending[(guild.id, user_id)] = loop.create_future()
+            try:
+                fetched = await self._fetch(guild, missing)
+                for user_id, name in fetched.items():
+                    self.cache.put(guild.id, user_id, name)
+                    futures[user_id].set_result(name)
+            finally:
+                for user_id, future in futures.items():
+                    self._pending.pop((guild.id, user_id), None)
+                    if not future.done():
+                        future.set_result(None)
+            names.update(fetched)
+        for user_id, future in waiting.items():
+            name = await asyncio.shield(future)
+            if name is not None:
+                names[user_id] = name
+        return names
+
+    async def _fetch(self, guild: discord.Guild, user_ids: list[int]) -> dict[int, str]:
+        self.fetches += 1
+        names = {}
+        try:
+            # メンバーはゲートウェイ経由で最大100人まで1回で取得できる
+            for start in range(0, len(user_ids), 100):
+                members = await guild.query_members(user_ids=user_ids[start:start + 100], cache=False)
+                names.update((member.id, member.display_name) for member in members)
+        except Exception as e:
+            print(f"Failed to query members: {type(e).__name__}: {e}")
+        # サーバーにいないユーザーだけ REST で取得する
+        rest = [user_id for user_id in user_ids if user_id not in names]
+        users = await asyncio.gather(*(self.client.fetch_user(user_id) for user_id in rest),
+                                     return_exceptions=True)
+        for user_id, user in zip(rest, users):
+            if isinstance(user, discord.User):
+                names[user_id] = user.display_name
+            else:
+                print(f"Failed to fetch user {user_id}: {user}")
+        return names
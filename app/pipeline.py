@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Per-guild speech pipeline.
+
+読み上げるメッセージを到着順に受け取り、先読みできる数だけ並行して合成しつつ、
+再生は必ず到着順に行う。メッセージは文ごとの区切りに分けて渡され、最初の区切りを
+再生している間に残りを合成する。
+
+溜まりすぎたときは BacklogPolicy に従って、古いものを捨てる・短いものをまとめる・
+早口にする、で追いつく。合成が期限に間に合わなかったものも読まずに捨てる。
+"""
+import asyncio
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import tracing
+from scheduler import DeadlineExceeded
+
+Prepare = Callable[[], Awaitable[list[str]]]
+Render = Callable[[str, float, bool, float | None], Awaitable[bytes]]
+Play = Callable[[bytes], Awaitable[None]]
+Started = Callable[[], None] | None
+Failed = Callable[[Exception], None] | None
+Gap = Callable[[float], None] | None
+
+# これで終わっている区切りは、まとめるときに句点を足さない
+_sentence_end = re.compile('[。．、，！？!?,.]$')
+
+
+@dataclass
+class BacklogPolicy:
+    """How a guild's queue catches up under burst; 0 disables each rule"""
+    # 待ちのメッセージ数の上限。超えたら読み始めていない古いものから丸ごと捨てる
+    max_depth: int = 0
+    # これより古いメッセージは読まずに捨てる(秒)
+    max_age: float = 0.0
+    # この文字数以下の区切りが続いていたら1回の合成にまとめる(別のメッセージどうしだけ)
+    coalesce_length: int = 0
+    # 待ちがこのメッセージ数以上のときだけまとめる
+    coalesce_backlog: int = 3
+    # まとめたときの最大文字数
+    coalesce_max: int = 60
+    # 待ちがこのメッセージ数以上になったら早口にする
+    speedup_backlog: int = 0
+    # 早口にするときの -r の倍率
+    speedup: float = 1.3
+
+
+class BacklogStats:
+    __slots__ = ('dropped', 'stale', 'coalesced', 'sped_up')
+
+    def __init__(self):
+        self.dropped = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.sped_up = 0
+
+    def add(self, other: 'BacklogStats'):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+class _Job:
+    __slots__ = ('submitted', 'urgent', 'on_start', 'on_error', 'task', 'trace', 'last', 'started')
+
+    def __init__(self, on_start: Started, on_error: Failed, urgent: bool):
+        self.submitted = time.monotonic()
+        self.urgent = urgent
+        self.on_start = on_start
+        self.on_error = on_error
+        self.task: asyncio.Task | None = None
+        # submit した時点のトレース。最後の区切りを再生し終えたら閉じる
+        self.trace = tracing.current.get()
+        self.last: _Segment | None = None
+        # 区切りの合成を1つでも始めたら、最後まで読む
+        self.started = False
+
+
+class _Segment:
+    __slots__ = ('text', 'jobs', 'starts', 'task')
+
+    def __init__(self, text: str, job: _Job, first: bool):
+        self.text = text
+        # まとめられたときは複数のメッセージの分を持つ
+        self.jobs = [job]
+        self.starts = [job.on_start] if first and job.on_start else []
+        self.task: asyncio.Task | None = None
+
+    @property
+    def submitted(self) -> float:
+        return self.jobs[0].submitted
+
+    @property
+    def urgent(self) -> bool:
+        return any(job.urgent for job in self.jobs)
+
+
+class SpeechPipeline:
+    """Ordered text-to-speech queue with bounded synthesis look-ahead"""
+
+    def __init__(self, render: Render, play: Play, lookahead: int = 2, policy: BacklogPolicy | None = None,
+                 on_gap: Gap = None):
+        # render(text, speed, urgent, deadline) は合成したクリップを返し、play は再生が終わるまで待つ
+        self._render = render
+        self._play = play
+        # 前のクリップが終わってから、すでに届いていた次のクリップが鳴るまでの無音(秒)を知らせる
+        self._on_gap = on_gap
+        self._last_end: float | None = None
+        self.lookahead = max(1, lookahead)
+        self.policy = policy or BacklogPolicy()
+        self.stats = BacklogStats()
+        # 区切りがまだ分からないメッセージ(到着順)
+        self._jobs: deque[_Job] = deque()
+        # 区切り済みで再生待ちのもの。先頭から _started 個は合成を始めている
+        self._segments: deque[_Segment] = deque()
+        self._started = 0
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return self._depth()
+
+    def submit(self, prepare: Prepare, on_start: Started = None, on_error: Failed = None, urgent: bool = False):
+        """Queue a message; prepare returns its segments in reading order
+
+        on_start is called when the first segment starts playing, on_error when
+        a segment fails to synthesize. Urgent messages are synthesized ahead of
+        other guilds' long messages.
+        """
+        self._enforce_depth()
+        job = _Job(on_start, on_error, urgent)
+        self._jobs.append(job)
+        job.task = asyncio.create_task(prepare())
+        job.task.add_done_callback(lambda _: self._collect())
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    def submit_text(self, text: str, on_start: Started = None, on_error: Failed = None, urgent: bool = False):
+        async def prepare() -> list[str]:
+            return [text]
+        self.submit(prepare, on_start, on_error, urgent)
+
+    def clear(self):
+        """Drop every pending message and stop the current clip"""
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        while self._jobs:
+            self._jobs.popleft().task.cancel()
+        while self._segments:
+            segment = self._segments.popleft()
+            if segment.task is not None:
+                segment.task.cancel()
+        self._started = 0
+
+    def _enforce_depth(self):
+        max_depth = self.policy.max_depth
+        if not max_depth:
+            return
+        while self._depth() >= max_depth:
+            # 読み始めていない一番古いメッセージを区切りごと捨てる。読んでいる途中のものは残りも読む
+            job = next((job for segment in self._segments for job in segment.jobs if not job.started), None)
+            if job is not None:
+                self._segments = deque(segment for segment in self._segments if job not in segment.jobs)
+            elif self._jobs:
+                job = self._jobs.popleft()
+                job.task.cancel()
+            else:
+                return
+            # 読まないのでトレースも閉じない
+            job.trace = None
+            self.stats.dropped += 1
+
+    def _depth(self) -> int:
+        """Messages waiting, however many segments each was split into"""
+        jobs = set(self._jobs)
+        for segment in self._segments:
+            jobs.update(segment.jobs)
+        return len(jobs)
+
+    def _collect(self):
+        # 区切りが分かったメッセージを到着順に再生待ちへ移す
+        while self._jobs and self._jobs[0].task.done():
+            job = self._jobs.popleft()
+            if job.task.cancelled():
+                continue
+            if job.task.exception() is not None:
+                print(f"Speech job failed: {job.task.exception()}")
+                continue
+            for index, text in enumerate(job.task.result()):
+                job.last = _Segment(text, job, index == 0)
+                self._segments.append(job.last)
+        self._fill()
+        self._wakeup.set()
+
+    def _fill(self):
+        policy = self.policy
+        now = time.monotonic()
+        while self._started < min(self.lookahead, len(self._segments)):
+            segment = self._segments[self._started]
+            if policy.max_age and now - segment.submitted > policy.max_age:
+                del self._segments[self._started]
+                self.stats.stale += 1
+                continue
+            depth = self._depth()
+            if (policy.coalesce_length and len(segment.text) <= policy.coalesce_length
+                    and depth >= policy.coalesce_backlog):
+                self._coalesce(segment)
+            speed = 1.0
+            if policy.speedup_backlog and depth >= policy.speedup_backlog:
+                speed = policy.speedup
+                self.stats.sped_up += 1
+            segment.task = asyncio.create_task(self._synthesize(segment, speed))
+            for job in segment.jobs:
+                job.started = True
+            self._started += 1
+
+    def _coalesce(self, segment: _Segment):
+        policy = self.policy
+        index = self._started + 1
+        while index < len(self._segments):
+            following = self._segments[index]
+            # 1つのメッセージの区切りは文ごとに読む(ストリーミングの意味が無くなる)
+            if len(following.text) > policy.coalesce_length or any(job in segment.jobs for job in following.jobs):
+                break
+            separator = '' if _sentence_end.search(segment.text) else '。'
+            if len(segment.text) + len(separator) + len(following.text) > policy.coalesce_max:
+                break
+            segment.text += separator + following.text
+            segment.jobs.extend(job for job in following.jobs if job not in segment.jobs)
+            segment.starts.extend(following.starts)
+            for job in following.jobs:
+                if job.last is following:
+                    job.last = segment
+            del self._segments[index]
+            self.stats.coalesced += 1
+
+    async def _synthesize(self, segment: _Segment, speed: float) -> bytes | None:
+        deadline = segment.submitted + self.policy.max_age if self.policy.max_age else None
+        self._mark(segment, 'lookahead')
+        # render の中(順番待ち)の記録は先頭のメッセージに付ける
+        tracing.current.set(segment.jobs[0].trace)
+        try:
+            clip = await self._render(segment.text, speed, segment.urgent, deadline)
+            self._mark(segment, 'synthesis')
+            return clip
+        except DeadlineExceeded:
+            self.stats.stale += 1
+            return None
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # 自分ではなく合成の方が止められた。この区切りだけ読まずに進める
+            print("TTS generation was cancelled")
+            return None
+        except Exception as e:
+            print(f"TTS generation failed: {e}")
+            for job in segment.jobs:
+                if job.on_error is not None:
+                    job.on_error(e)
+            return None
+
+    async def _run(self):
+        while self._jobs or self._segments:
+            if not self._segments or self._segments[0].task is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            segment = self._segments[0]
+            try:
+                clip = await asyncio.shield(segment.task)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling() or not segment.task.cancelled():
+                    raise
+                # 区切りの合成だけが止められたときは、それを飛ばして次を読む
+                clip = None
+            self._segments.popleft()
+            self._started -= 1
+            # 再生を始める時点で次の合成に枠を回す
+            self._fill()
+            if clip is None:
+                continue
+            if self.policy.max_age and time.monotonic() - segment.submitted > self.policy.max_age:
+                self.stats.stale += 1
+                continue
+            now = time.monotonic()
+            if self._on_gap is not None and self._last_end is not None and segment.submitted < self._last_end:
+                self._on_gap(now - self._last_end)
+            self._mark(segment, 'backlog')
+            for on_start in segment.starts:
+                on_start()
+            try:
+                await self._play(clip)
+            except Exception as e:
+                print(f"Failed to play audio: {e}")
+            self._last_end = time.monotonic()
+            for job in segment.jobs:
+                if job.last is segment and job.trace is not None:
+                    job.trace.finish()
+
+    @staticmethod
+    def _mark(segment: _Segment, stage: str):
+        for job in segment.jobs:
+            if job.trace is not None:
+                job.trace.mark(stage)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Synthesis scheduling across guilds.
+
+合成の枠は全サーバーで共有するので、先着順ではなくサーバーごとの重み付き公平キュー
+(WFQ)で順番を決める。挨拶と短いメッセージは仮想時間の進みを小さくして先に回すが、
+順番はあくまで仮想終了時刻で決まるので、短いものを出し続けるサーバーも他を待たせ続けない。
+間に合わなくなったものは合成せずに捨てる。挨拶の事前合成などの後回しでよいものは、他に待ちが無いときだけ回す。
+後回しのものを今読む人が待ち始めたら promote() で普通の順番に繰り上げる。
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+
+class DeadlineExceeded(Exception):
+    """The job could not start synthesizing in time to be played"""
+
+
+@dataclass
+class Ticket:
+    """Who a synthesis is for and how urgent it is"""
+    guild_id: int = 0
+    # 挨拶など、すぐ読みたいもの
+    urgent: bool = False
+    # これまでに合成し終わらないなら不要(time.monotonic() の値)
+    deadline: float | None = None
+    # 合成の順番待ちにかかった時間(ms)を記録する先
+    waits: deque | None = None
+    # 今は読まない事前合成。他の合成より後に回し、サーバーの持ち分も使わない
+    background: bool = False
+
+
+class _Waiter:
+    __slots__ = ('ticket', 'length', 'start', 'enqueued', 'future')
+
+    def __init__(self, ticket: Ticket, length: int, start: float, future: asyncio.Future):
+        self.ticket = ticket
+        self.length = length
+        self.start = start
+        self.enqueued = time.monotonic()
+        self.future = future
+
+
+class SynthesisScheduler:
+    """Weighted fair queuing of synthesis slots across guilds"""
+
+    def __init__(self, budget: int, short_length: int = 20):
+        self.budget = max(1, budget)
+        # この文字数以下は短いメッセージとして先に回す
+        self.short_length = short_length
+        self.in_use = 0
+        self.expired = 0
+        self._queue: list[tuple[int, float, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._finish: dict[int, float] = dict()
+        # 1回の合成にかかる時間の見積もり(秒)
+        self._estimate = 0.0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @asynccontextmanager
+    async def slot(self, ticket: Ticket, length: int):
+        """Wait for a synthesis slot; raises DeadlineExceeded if it comes too late"""
+        guild_id = ticket.guild_id
+        # 後回しでよいものは別の段にして、他の待ちが無いときだけ回す
+        tier = 1 if ticket.background else 0
+        start = max(self._virtual_time, self._finish.get(guild_id, 0.0))
+        finish = start + self._cost(ticket, length)
+        if not ticket.background:
+            self._finish[guild_id] = finish
+        waiter = _Waiter(ticket, length, start, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (tier, finish, next(self._sequence), waiter))
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # 枠をもらった直後にキャンセルされたら返す
+                self._release()
+            raise
+        began = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - began
+            self._estimate = elapsed if not self._estimate else self._estimate * 0.8 + elapsed * 0.2
+            self._release()
+
+    def promote(self, ticket: Ticket):
+        """Requeue a waiting job whose ticket became urgent or stopped being background"""
+        for index, (tier, finish, sequence, waiter) in enumerate(self._queue):
+            if waiter.ticket is ticket and not waiter.future.done():
+                break
+        else:
+            # もう合成を始めているか、終わっている
+            return
+        if ticket.background:
+            return
+        if tier:
+            # 後回しの段から出すので、ここからサーバーの持ち分を使う
+            waiter.start = max(self._virtual_time, self._finish.get(ticket.guild_id, 0.0))
+            finish = self._finish[ticket.guild_id] = waiter.start + self._cost(ticket, waiter.length)
+        else:
+            finish = min(finish, waiter.start + self._cost(ticket, waiter.length))
+        self._queue[index] = (0, finish, sequence, waiter)
+        heapq.heapify(self._queue)
+        self._dispatch()
+
+    def _cost(self, ticket: Ticket, length: int) -> float:
+        # 長いものほど仮想時間を多く進めるので、長文ばかりのサーバーは後ろに回る。
+        # 挨拶と短いものは進みを小さくするだけで、他のサーバーを追い越し続けはしない
+        if ticket.urgent:
+            return 1.0
+        if length <= self.short_length:
+            return 1 + length / 2
+        return 1.0 + length
+
+    def _release(self):
+        self.in_use -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.in_use < self.budget and self._queue:
+            _, _, _, waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                continue
+            ticket = waiter.ticket
+            if ticket.deadline is not None and now + self._estimate > ticket.deadline:
+                self.expired += 1
+                waiter.future.set_exception(DeadlineExceeded())
+                continue
+            if waiter.start > self._virtual_time:
+                self._virtual_time = waiter.start
+                # 仮想時間に追い越されたサーバーは覚えておかなくてよい
+                if len(self._finish) > 1000:
+                    self._finish = {guild_id: finish for guild_id, finish in self._finish.items()
+                                    if finish > self._virtual_time}
+            if ticket.waits is not None:
+                ticket.waits.append((now - waiter.enqueued) * 1000)
+            self.in_use += 1
+            waiter.future.set_result(None)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Per-guild reading sessions.
+
+1つのプロセスで複数のサーバーを読み上げられるように、サーバーごとの状態をまとめて持つ。
+"""
+import asyncio
+from collections import deque
+
+import discord
+
+from audio import ClipStream
+from pipeline import BacklogStats, SpeechPipeline
+from tts import VoiceParams
+
+
+class GuildSession:
+    """State of one guild's reading session"""
+
+    __slots__ = (
+        'guild_id', 'text_channel_id', 'voice_client', 'pipeline', 'volume', 'voice',
+        'messages_read', 'ttfa', 'queue_wait', 'stream', 'stream_stopped',
+        'reconnecting', 'prerendering',
+    )
+
+    def __init__(self, guild_id: int, text_channel_id: int, voice_client: discord.VoiceClient,
+                 pipeline: SpeechPipeline, voice: VoiceParams, volume: float = 1.0):
+        self.guild_id = guild_id
+        # 読み上げるテキストチャンネル
+        self.text_channel_id = text_channel_id
+        self.voice_client = voice_client
+        self.pipeline = pipeline
+        # 合成したクリップに掛ける音量(1.0 で揃えた音量のまま)
+        self.volume = volume
+        self.voice = voice
+        self.messages_read = 0
+        # メッセージ受信から最初の音が出るまでの時間(ms)
+        self.ttfa: deque[float] = deque(maxlen=200)
+        # 合成の順番待ちにかかった時間(ms)
+        self.queue_wait: deque[float] = deque(maxlen=200)
+        # 再生中の連続した音声(ClipStream)と、その再生が止まったら完了する Future
+        self.stream: ClipStream | None = None
+        self.stream_stopped: asyncio.Future | None = None
+        # 切れたボイスの接続をつなぎ直しているタスク
+        self.reconnecting: asyncio.Task | None = None
+        # 挨拶を前もって合成しているタスク
+        self.prerendering: set[asyncio.Task] = set()
+
+    def is_connected(self) -> bool:
+        return self.voice_client is not None and self.voice_client.is_connected()
+
+    def close(self):
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+        for task in list(self.prerendering):
+            task.cancel()
+        self.pipeline.clear()
+
+
+class SessionRegistry:
+    """Sessions keyed by guild ID"""
+
+    def __init__(self):
+        self._sessions: dict[int, GuildSession] = dict()
+        # 終わったセッションの集計(累計を出すときに足す)
+        self.retired = BacklogStats()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def get(self, guild_id: int) -> GuildSession | None:
+        return self._sessions.get(guild_id)
+
+    def add(self, session: GuildSession) -> GuildSession:
+        old = self._sessions.get(session.guild_id)
+        if old is not None:
+            self._retire(old)
+        self._sessions[session.guild_id] = session
+        return session
+
+    def remove(self, guild_id: int) -> GuildSession | None:
+        session = self._sessions.pop(guild_id, None)
+        if session is not None:
+            self._retire(session)
+        return session
+
+    def backlog_totals(self) -> BacklogStats:
+        """Backlog counters summed over current and finished sessions"""
+        totals = BacklogStats()
+        totals.add(self.retired)
+        for session in self._sessions.values():
+            totals.add(session.pipeline.stats)
+        return totals
+
+    def _retire(self, session: GuildSession):
+        session.close()
+        self.retired.add(session.pipeline.stats)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of synthesized clips.
+
+メモリ上の LRU と、任意でディスク上の LRU の2段構成。どちらもバイト数で上限を決める。
+ディスク側は複数のプロセスで共有できる(shared のときは他のプロセスが書いたファイルも読む)。
+"""
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+from tts import VoiceParams
+
+
+class AudioCache:
+    """LRU cache of ready-to-play clips keyed on text and voice parameters"""
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0, shared: bool = False):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.shared = shared
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        if disk_dir:
+            self._load_disk_index()
+
+    @staticmethod
+    def key(text: str, params: VoiceParams, encoding: str = 'pcm', gain: float = 1.0) -> str:
+        # 同じ文言でも保存している形式や音量が違えば別のクリップとして扱う
+        material = '\0'.join((encoding, repr(gain), params.voice, repr(params.pitch), repr(params.speed), text))
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    @property
+    def disk_bytes(self) -> int:
+        return self._disk_bytes
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    async def get(self, key: str) -> bytes | None:
+        clip = self._memory.get(key)
+        if clip is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return clip
+        if key in self._disk or (self.disk_dir and self.shared):
+            try:
+                clip = await asyncio.to_thread(self._read_file, key)
+            except OSError:
+                self._drop_disk(key)
+            else:
+                if key not in self._disk:
+                    # 他のプロセスが書いたファイル
+                    self._disk[key] = len(clip)
+                    self._disk_bytes += len(clip)
+                self._disk.move_to_end(key)
+                self.disk_hits += 1
+                self._remember(key, clip)
+                return clip
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, clip: bytes):
+        self._remember(key, clip)
+        if not self.disk_dir or key in self._disk or len(clip) > self.disk_max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write_file, key, clip)
+        except OSError as e:
+            print(f"Failed to write audio cache file: {e}")
+            return
+        self._disk[key] = len(clip)
+        self._disk_bytes += len(clip)
+        while self._disk_bytes > self.disk_max_bytes:
+            oldest = next(iter(self._disk))
+            self._drop_disk(oldest)
+
+    def _remember(self, key: str, clip: bytes):
+        if len(clip) > self.max_bytes or key in self._memory:
+            return
+        self._memory[key] = clip
+        self._memory_bytes += len(clip)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key)
+
+    def _read_file(self, key: str) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            clip = f.read()
+        # 再起動後も LRU の順番が分かるように mtime を更新しておく
+        os.utime(self._path(key))
+        return clip
+
+    def _write_file(self, key: str, clip: bytes):
+        # 書きかけのファイルを読まないように一時ファイルから置き換える
+        tmp = f'{self._path(key)}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(clip)
+        os.replace(tmp, self._path(key))
+
+    def _drop_disk(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is None:
+            return
+        self._disk_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and len(entry.name) == 64:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        # 古いものから並べて LRU の順番を復元する
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            self._drop_disk(next(iter(self._disk)))
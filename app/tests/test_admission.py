@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""AdmissionControl の連投・繰り返しの弾き方のテスト。app/ で `python -m unittest` で実行する。"""
+import unittest
+from unittest import mock
+
+from admission import AdmissionControl
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('admission.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_user_bucket_refills_over_time(self):
+        # 1文字のメッセージは 1.02 トークン
+        admission = AdmissionControl(user_rate=1.0, user_burst=2.5, guild_rate=0, guild_burst=0, repeat_window=0)
+        self.assertIsNone(admission.admit(1, 10, 'あ'))
+        self.assertIsNone(admission.admit(1, 10, 'い'))
+        self.assertEqual(admission.admit(1, 10, 'う'), 'user')
+        # 別のユーザーは別のバケツ
+        self.assertIsNone(admission.admit(1, 11, 'う'))
+        self.clock.now += 1.1
+        self.assertIsNone(admission.admit(1, 10, 'え'))
+        self.assertEqual(admission.admitted, 4)
+        self.assertEqual(admission.rejected['user'], 1)
+
+    def test_long_message_costs_more(self):
+        admission = AdmissionControl(user_rate=1.0, user_burst=3, guild_rate=0, guild_burst=0, repeat_window=0,
+                                     chars_per_token=50)
+        # 上限より重くても満タンなら通すが、その分は借りになる
+        self.assertIsNone(admission.admit(1, 10, 'あ' * 200))
+        self.clock.now += 1.0
+        self.assertEqual(admission.admit(1, 10, 'い'), 'user')
+        self.clock.now += 2.1
+        self.assertIsNone(admission.admit(1, 10, 'い'))
+
+    def test_guild_bucket_is_shared_by_users(self):
+        admission = AdmissionControl(user_rate=1.0, user_burst=5, guild_rate=1.0, guild_burst=3.5, repeat_window=0)
+        for user_id in range(3):
+            self.assertIsNone(admission.admit(1, user_id, 'あ'))
+        self.assertEqual(admission.admit(1, 3, 'あ'), 'guild')
+        # 他のサーバーには影響しない
+        self.assertIsNone(admission.admit(2, 3, 'あ'))
+
+    def test_user_rejection_does_not_spend_guild_tokens(self):
+        admission = AdmissionControl(user_rate=0.1, user_burst=1, guild_rate=0.1, guild_burst=2.5, repeat_window=0)
+        self.assertIsNone(admission.admit(1, 10, 'あ'))
+        for _ in range(5):
+            self.assertEqual(admission.admit(1, 10, 'い'), 'user')
+        self.assertIsNone(admission.admit(1, 11, 'う'))
+
+    def test_repeat_within_window_is_rejected(self):
+        admission = AdmissionControl(user_rate=0, user_burst=0, guild_rate=0, guild_burst=0, repeat_window=10.0)
+        self.assertIsNone(admission.admit(1, 10, '草'))
+        # 別のユーザーが同じ文面を送っても1回にまとめる
+        self.assertEqual(admission.admit(1, 11, '草'), 'repeat')
+        self.assertIsNone(admission.admit(2, 10, '草'))
+        self.clock.now += 10.0
+        self.assertIsNone(admission.admit(1, 10, '草'))
+        self.assertEqual(admission.rejected['repeat'], 1)
+
+    def test_notice_once_per_interval(self):
+        admission = AdmissionControl(user_rate=0, user_burst=0, guild_rate=0, guild_burst=0, notice_interval=60.0)
+        self.assertTrue(admission.should_notify(1))
+        self.assertFalse(admission.should_notify(1))
+        self.assertTrue(admission.should_notify(2))
+        self.clock.now += 60.0
+        self.assertTrue(admission.should_notify(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
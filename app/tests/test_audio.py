@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""ClipStream のクリップの並び・つなぎの無音・終了の知らせのテスト。app/ で `python -m unittest` で実行する。
+
+ボイスのスレッドの代わりに read() を1フレームずつ呼ぶ。
+"""
+import unittest
+
+from audio import FRAME_SIZE, ClipStream, PCMBufferSource
+
+SILENCE = bytes(FRAME_SIZE)
+
+
+def frame(n: int) -> bytes:
+    return bytes([n]) * FRAME_SIZE
+
+
+class ClipStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.events: list[str] = []
+
+    def add(self, stream: ClipStream, name: str, frames: list[int]) -> bool:
+        source = PCMBufferSource(b''.join(frame(n) for n in frames))
+        return stream.add(source, lambda: self.events.append(f'end {name}'))
+
+    def read(self, stream: ClipStream) -> bytes:
+        data = stream.read()
+        self.events.append('silence' if data == SILENCE else f'frame {data[0]}' if data else 'closed')
+        return data
+
+    def test_clips_play_in_order_and_end_after_their_last_frame(self):
+        stream = ClipStream(False, linger=2)
+        self.add(stream, 'a', [1, 2])
+        self.add(stream, 'b', [3])
+        for _ in range(6):
+            self.read(stream)
+        # 最後のフレームを返す read() の中で終わりを知らせ(記録はそのフレームの前に並ぶ)、
+        # クリップの間に無音は入れない
+        self.assertEqual(self.events, [
+            'frame 1', 'end a', 'frame 2', 'end b', 'frame 3', 'silence', 'silence', 'closed',
+        ])
+
+    def test_clip_added_while_lingering_continues_the_stream(self):
+        stream = ClipStream(False, linger=3)
+        self.add(stream, 'a', [1])
+        self.read(stream)
+        self.read(stream)
+        self.read(stream)
+        self.assertTrue(self.add(stream, 'b', [2]))
+        self.read(stream)
+        # 無音を数え直すので、また linger フレームまで待つ
+        for _ in range(4):
+            self.read(stream)
+        self.assertEqual(self.events, [
+            'end a', 'frame 1', 'silence', 'silence', 'end b', 'frame 2',
+            'silence', 'silence', 'silence', 'closed',
+        ])
+
+    def test_add_after_close_is_refused(self):
+        stream = ClipStream(False, linger=1)
+        self.read(stream)
+        self.read(stream)
+        self.assertFalse(self.add(stream, 'late', [1]))
+        self.assertEqual(self.events, ['silence', 'closed'])
+
+    def test_empty_clip_is_skipped(self):
+        stream = ClipStream(False, linger=1)
+        self.add(stream, 'empty', [])
+        self.add(stream, 'a', [1])
+        self.read(stream)
+        self.assertEqual(self.events, ['end empty', 'end a', 'frame 1'])
+
+    def test_cleanup_ends_current_and_queued_clips_in_order(self):
+        stream = ClipStream(False, linger=1)
+        self.add(stream, 'a', [1, 2, 3])
+        self.add(stream, 'b', [4])
+        self.add(stream, 'c', [5])
+        self.read(stream)
+        stream.cleanup()
+        self.assertEqual(self.events, ['frame 1', 'end a', 'end b', 'end c'])
+        self.assertFalse(self.add(stream, 'd', [6]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""ReadingDictionary の置換と DictionaryStore の保存・読み直しのテスト。app/ で `python -m unittest` で実行する。"""
+import os
+import tempfile
+import unittest
+
+from dictionary import DictionaryStore, ReadingDictionary
+
+
+class ReadingDictionaryTest(unittest.TestCase):
+    def test_longest_match_wins(self):
+        dictionary = ReadingDictionary([('東京', 'とうきょう'), ('東京都', 'とうきょうと'), ('東', 'ひがし')])
+        self.assertEqual(dictionary.replace('東京都、東京、東'), 'とうきょうと、とうきょう、ひがし')
+
+    def test_overlapping_keys_replace_from_the_left(self):
+        dictionary = ReadingDictionary([('ab', 'X'), ('bc', 'Y')])
+        # 置き換えた部分はもう一度見ない
+        self.assertEqual(dictionary.replace('abc'), 'Xc')
+        self.assertEqual(dictionary.replace('aabcc'), 'aXcc')
+
+    def test_prefix_without_match_falls_back(self):
+        dictionary = ReadingDictionary([('abcd', 'X'), ('b', 'Y')])
+        # 長い単語の途中で外れたら、次の文字から探し直す
+        self.assertEqual(dictionary.replace('abce'), 'aYce')
+
+    def test_first_duplicate_is_used(self):
+        dictionary = ReadingDictionary([('草', 'くさ'), ('草', 'わら')])
+        self.assertEqual(dictionary.replace('草'), 'くさ')
+        self.assertEqual(len(dictionary), 1)
+
+    def test_empty_dictionary_keeps_text(self):
+        self.assertEqual(ReadingDictionary().replace('そのまま'), 'そのまま')
+
+
+class DictionaryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='dict-test-'), 'dictionary.sqlite3')
+        self.store = DictionaryStore(self.path)
+        self.addCleanup(self.store.close)
+
+    def test_add_and_remove(self):
+        self.store.add('草', 'くさ')
+        self.store.add('w', 'わら')
+        version = self.store.version
+        self.assertEqual(self.store.replace('草w'), 'くさわら')
+        self.assertTrue(self.store.remove(1))
+        self.assertEqual(self.store.pairs(), [('w', 'わら')])
+        self.assertEqual(self.store.replace('草w'), '草わら')
+        self.assertGreater(self.store.version, version)
+        # /get の番号の範囲外は消さない
+        self.assertFalse(self.store.remove(0))
+        self.assertFalse(self.store.remove(2))
+
+    def test_entries_survive_reopen(self):
+        self.store.add('草', 'くさ')
+        self.store.close()
+        self.store = DictionaryStore(self.path)
+        self.assertEqual(self.store.pairs(), [('草', 'くさ')])
+
+    def test_refresh_picks_up_other_connection(self):
+        other = DictionaryStore(self.path)
+        self.addCleanup(other.close)
+        self.assertFalse(self.store.refresh())
+        other.add('草', 'くさ')
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(self.store.replace('草'), 'くさ')
+        # 変わっていなければ読み直さない
+        self.assertFalse(self.store.refresh())
+        # 自分の変更では読み直さない
+        self.store.add('w', 'わら')
+        self.assertFalse(self.store.refresh())
+        self.assertTrue(other.refresh())
+        self.assertEqual(other.replace('草w'), 'くさわら')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""SpeechPipeline の溜まったときの追いつき方のテスト。app/ で `python -m unittest` で実行する。"""
+import asyncio
+import unittest
+
+from pipeline import BacklogPolicy, SpeechPipeline
+
+POLICY = BacklogPolicy(coalesce_length=15, coalesce_max=60, coalesce_backlog=3, speedup_backlog=5, speedup=1.3)
+
+
+class PipelineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.rendered: list[tuple[str, float]] = []
+        self.played: list[bytes] = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def render(self, text: str, speed: float, urgent: bool, deadline: float | None) -> bytes:
+        self.rendered.append((text, speed))
+        return text.encode()
+
+    async def play(self, clip: bytes):
+        await self.release.wait()
+        self.played.append(clip)
+
+    def pipeline(self) -> SpeechPipeline:
+        return SpeechPipeline(self.render, self.play, 2, POLICY)
+
+    def submit(self, pipeline: SpeechPipeline, segments: list[str]):
+        async def prepare() -> list[str]:
+            return segments
+        pipeline.submit(prepare)
+
+    async def drain(self, pipeline: SpeechPipeline):
+        for _ in range(200):
+            if not len(pipeline) and len(self.played) == len(self.rendered):
+                return
+            await asyncio.sleep(0.01)
+        self.fail('pipeline did not drain')
+
+    async def test_idle_message_keeps_its_sentences(self):
+        pipeline = self.pipeline()
+        segments = ['たろうこんにちは。', '今日は晴れ。', '明日は雨です。', 'よろしくね。']
+        self.submit(pipeline, segments)
+        await self.drain(pipeline)
+        self.assertEqual([text for text, _ in self.rendered], segments)
+        self.assertEqual(pipeline.stats.coalesced, 0)
+
+    async def test_long_message_is_not_sped_up(self):
+        pipeline = self.pipeline()
+        segments = [f'{n}番目の文はそれなりに長いので読点でも区切られる。' for n in range(10)]
+        self.submit(pipeline, segments)
+        await self.drain(pipeline)
+        self.assertEqual(len(self.rendered), 10)
+        self.assertTrue(all(speed == 1.0 for _, speed in self.rendered))
+        self.assertEqual(pipeline.stats.sped_up, 0)
+
+    async def test_backlog_coalesces_across_messages(self):
+        pipeline = self.pipeline()
+        self.release.clear()
+        for text in ('あ。', 'い', 'う！', 'え'):
+            self.submit(pipeline, [text])
+        await asyncio.sleep(0.05)
+        self.release.set()
+        await self.drain(pipeline)
+        # 句点や感嘆符で終わっているところには句点を足さない
+        self.assertEqual([text for text, _ in self.rendered], ['あ。い。う！え'])
+        self.assertEqual(pipeline.stats.coalesced, 3)
+
+    async def test_short_queue_is_not_coalesced(self):
+        pipeline = self.pipeline()
+        for text in ('あ', 'い'):
+            self.submit(pipeline, [text])
+        await self.drain(pipeline)
+        self.assertEqual([text for text, _ in self.rendered], ['あ', 'い'])
+        self.assertEqual(pipeline.stats.coalesced, 0)
+
+
+    async def test_depth_limit_drops_whole_unread_messages(self):
+        pipeline = SpeechPipeline(self.render, self.play, 2, BacklogPolicy(max_depth=2))
+        self.release.clear()
+        first = [f'{n}番目の文。' for n in range(35)]
+        self.submit(pipeline, first)
+        await asyncio.sleep(0.01)
+        # 35文あっても1件と数える
+        self.assertEqual(len(pipeline), 1)
+        self.submit(pipeline, ['次のメッセージ。', 'その続き。'])
+        await asyncio.sleep(0.01)
+        self.submit(pipeline, ['最後のメッセージ。'])
+        await asyncio.sleep(0.01)
+        self.release.set()
+        await self.drain(pipeline)
+        # 読んでいる途中のメッセージは最後まで読み、読み始めていない2件目を丸ごと捨てる
+        self.assertEqual(self.played, [text.encode() for text in first + ['最後のメッセージ。']])
+        self.assertEqual(pipeline.stats.dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""render() の相乗りと取り消しのテスト。app/ で `python -m unittest` で実行する。
+
+Discord にも OpenJTalk にもつながずに app.py を読み込み、合成は待つだけのものに差し替える。
+"""
+import asyncio
+import atexit
+import contextlib
+import os
+import types
+import unittest
+
+from benchmarks import load
+
+load.configure_environment(types.SimpleNamespace(workers=0))
+
+with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    import app
+
+atexit.unregister(app.cleanup_all)
+
+
+class RenderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = app.synthesis_engine
+        app.synthesis_engine = load.StubSynthesizer(0.05, 0, 50)
+
+    async def asyncTearDown(self):
+        app.synthesis_engine = self.engine
+
+    async def test_render_after_cancel_starts_again(self):
+        first = asyncio.create_task(app.render('取り消し後の再合成'))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        # 最後の人が抜けて止めた合成には相乗りせず、新しく合成する
+        clip = await app.render('取り消し後の再合成')
+        self.assertTrue(clip)
+        self.assertTrue(first.cancelled())
+
+    async def test_other_caller_keeps_shared_render(self):
+        first = asyncio.create_task(app.render('相乗りの合成'))
+        second = asyncio.create_task(app.render('相乗りの合成'))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertTrue(await second)
+        self.assertEqual(app.synthesis_engine.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""SynthesisScheduler の順番のテスト。app/ で `python -m unittest` で実行する。"""
+import asyncio
+import unittest
+
+from scheduler import SynthesisScheduler, Ticket
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def run_jobs(self, scheduler: SynthesisScheduler, jobs: list[tuple[str, Ticket, int]],
+                       queued=None) -> list[str]:
+        order = []
+
+        async def job(name: str, ticket: Ticket, length: int):
+            async with scheduler.slot(ticket, length):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        # 枠を埋めておき、全部並んでから順番を見る
+        blocker = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot(Ticket(0), 1):
+                await blocker.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(job(*args)) for args in jobs]
+        await asyncio.sleep(0)
+        if queued is not None:
+            queued()
+        blocker.set()
+        await asyncio.gather(holder, *tasks)
+        return order
+
+    async def test_short_stream_does_not_starve_other_guild(self):
+        scheduler = SynthesisScheduler(1, short_length=20)
+        jobs = [(f'short{n}', Ticket(1), 20) for n in range(20)]
+        jobs.insert(1, ('long', Ticket(2), 60))
+        order = await self.run_jobs(scheduler, jobs)
+        # 短いものが何件並んでいても、長いものは数件のうちに回ってくる
+        self.assertLess(order.index('long'), 8)
+
+    async def test_greeting_goes_before_long_message(self):
+        scheduler = SynthesisScheduler(1, short_length=20)
+        order = await self.run_jobs(scheduler, [
+            ('long', Ticket(1), 80),
+            ('greeting', Ticket(2, urgent=True), 12),
+        ])
+        self.assertEqual(order, ['greeting', 'long'])
+
+    async def test_background_waits_for_everything_else(self):
+        scheduler = SynthesisScheduler(1, short_length=20)
+        order = await self.run_jobs(scheduler, [
+            ('prerender', Ticket(1, background=True), 10),
+            ('long', Ticket(2), 200),
+        ])
+        self.assertEqual(order, ['long', 'prerender'])
+
+
+    async def test_promoted_background_goes_ahead(self):
+        scheduler = SynthesisScheduler(1, short_length=20)
+        prerender = Ticket(1, background=True)
+
+        def greeting_joins():
+            # 挨拶が事前合成に相乗りした
+            prerender.background = False
+            prerender.urgent = True
+            scheduler.promote(prerender)
+
+        order = await self.run_jobs(scheduler, [
+            ('prerender', prerender, 10),
+            ('long', Ticket(2), 200),
+        ], queued=greeting_joins)
+        self.assertEqual(order, ['prerender', 'long'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""SynthesisServer が壊れたリクエストで枠を失わないことのテスト。app/ で `python -m unittest` で実行する。"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+from tts import VoiceParams
+from tts_service import (ENCODING_RAW, REQUEST_HEADER, RESPONSE_HEADER, STATUS_ERROR, STATUS_OK, SynthesisServer,
+                         pack_request)
+
+
+class SilentEngine:
+    async def synthesize(self, text: str, params: VoiceParams) -> tuple[bytes, int]:
+        return b'\0\0' * len(text), 24000
+
+
+class SynthesisServerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_malformed_request_releases_its_slot(self):
+        # 接続ごと・全体とも1件ずつしか受け付けないので、枠が漏れたら次のリクエストは止まる
+        server = SynthesisServer(SilentEngine(), max_inflight=1, max_pending=1)
+        path = os.path.join(tempfile.mkdtemp(prefix='tts-test-'), 'tts.sock')
+        listener = await asyncio.start_unix_server(server._handle, path)
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            encoding = ENCODING_RAW.encode()
+            broken = b'\xff\xfe'
+            writer.write(REQUEST_HEADER.pack(1, 0.0, 1.0, 1.0, len(encoding), 0, len(broken)) + encoding + broken)
+            writer.write(pack_request(2, 'あいう', VoiceParams('voice'), ENCODING_RAW))
+            statuses = {}
+            for _ in range(2):
+                request_id, status, _, length = RESPONSE_HEADER.unpack(
+                    await asyncio.wait_for(reader.readexactly(RESPONSE_HEADER.size), 5))
+                await reader.readexactly(length)
+                statuses[request_id] = status
+            self.assertEqual(statuses, {1: STATUS_ERROR, 2: STATUS_OK})
+            self.assertEqual(server.errors, 1)
+        finally:
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+
+
+if __name__ == '__main__':
+    unittest.main()
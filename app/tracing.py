@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Per-message latency tracing.
+
+メッセージを受け取ってから再生し終わるまでの各段階の時刻を記録する。
+段階は終わった時点で mark() し、同じ段階は最初の1回だけ残す(1通目の区切りの値になる)。
+終わったトレースはリングバッファに入れ、指定があれば JSON Lines でファイルにも書き出す。
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from contextvars import ContextVar
+
+# 段階の並び順。各段階の時間は、その段階と直前に記録された段階の時刻の差
+STAGES = (
+    'admission',   # 連投チェック
+    'mentions',    # メンションの名前解決
+    'dictionary',  # 辞書の置換などテキストの整形
+    'lookahead',   # 先読みの枠が空くまで
+    'queue',       # 合成の順番待ち(キャッシュにあれば無し)
+    'synthesis',   # 合成
+    'backlog',     # 前のクリップの再生が終わるまで
+    'playback',    # 再生し終わるまで(最後の区切りまで)
+)
+
+# 今処理しているメッセージのトレース。タスクを作ると引き継がれる
+current: ContextVar['Trace | None'] = ContextVar('trace', default=None)
+
+
+class Trace:
+    __slots__ = ('tracer', 'guild_id', 'message_id', 'received', 'marks')
+
+    def __init__(self, tracer: 'Tracer', guild_id: int, message_id: int):
+        self.tracer = tracer
+        self.guild_id = guild_id
+        self.message_id = message_id
+        self.received = time.monotonic()
+        self.marks: dict[str, float] = dict()
+
+    def mark(self, stage: str, last: bool = False):
+        """Record the end of stage; only the first mark counts unless last is set"""
+        if last or stage not in self.marks:
+            self.marks[stage] = time.monotonic()
+
+    def finish(self):
+        """Mark the end of playback and hand the trace to its tracer"""
+        self.mark('playback', last=True)
+        self.tracer.finish(self)
+
+    def durations(self) -> dict[str, float]:
+        """Milliseconds spent in each recorded stage"""
+        durations = {}
+        previous = self.received
+        for stage in STAGES:
+            if stage in self.marks:
+                durations[stage] = (self.marks[stage] - previous) * 1000
+                previous = self.marks[stage]
+        return durations
+
+
+def mark(stage: str):
+    """Mark stage on the current task's trace, if it has one"""
+    trace = current.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+class Tracer:
+    """Ring buffer of finished traces with optional JSON Lines export"""
+
+    def __init__(self, size: int = 2000, export_path: str | None = None):
+        self.traces: deque[Trace] = deque(maxlen=size)
+        self.export_path = export_path
+        self._pending: list[str] = []
+        self._flushing: asyncio.Task | None = None
+
+    def begin(self, guild_id: int, message_id: int) -> Trace:
+        trace = Trace(self, guild_id, message_id)
+        current.set(trace)
+        return trace
+
+    def finish(self, trace: Trace):
+        self.traces.append(trace)
+        if not self.export_path:
+            return
+        self._pending.append(json.dumps({
+            'guild': trace.guild_id, 'message': trace.message_id,
+            'received': time.time() - (time.monotonic() - trace.received),
+            'stages_ms': {stage: round(ms, 2) for stage, ms in trace.durations().items()},
+        }))
+        # 書き込みはまとめてスレッドで行う
+        if len(self._pending) >= 50 and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        lines, self._pending = self._pending, []
+        if lines:
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except OSError as e:
+                print(f"Failed to export traces: {e}")
+
+    def close(self):
+        lines, self._pending = self._pending, []
+        if lines and self.export_path:
+            self._write(lines)
+
+    def _write(self, lines: list[str]):
+        with open(self.export_path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def summary(self, guild_id: int) -> dict[str, tuple[float, float, int]]:
+        """(p50, p95, samples) in milliseconds for each stage of a guild's recent messages"""
+        samples: dict[str, list[float]] = {}
+        for trace in self.traces:
+            if trace.guild_id == guild_id:
+                for stage, ms in trace.durations().items():
+                    samples.setdefault(stage, []).append(ms)
+        result = {}
+        for stage in STAGES:
+            values = sorted(samples.get(stage, ()))
+            if values:
+                result[stage] = (values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.95))],
+                                 len(values))
+        return result
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""OpenJTalk synthesis engine.
+
+常駐ワーカーのプールで音声合成を行う。ワーカーは pyopenjtalk で辞書と
+音響モデルを読み込んだまま待機し、標準入出力の簡単なフレームでジョブを受け取る。
+pyopenjtalk が使えない環境では open_jtalk コマンドを1回ずつ起動する方式に
+フォールバックする。
+"""
+import asyncio
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+import wave
+from dataclasses import dataclass
+
+DIC_DIR = '/var/lib/mecab/dic/open-jtalk/naist-jdic'
+VOICE_PATH = '/usr/share/hts-voice/mei/mei_normal.htsvoice'
+
+# request:  >I (payload length) + JSON payload
+# response: >BII (status, sample rate, payload length) + payload
+REQUEST_HEADER = struct.Struct('>I')
+RESPONSE_HEADER = struct.Struct('>BII')
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+@dataclass(frozen=True)
+class VoiceParams:
+    """Voice parameters passed to OpenJTalk (-m, -fm, -r)"""
+    voice: str = VOICE_PATH
+    pitch: float = -5.0
+    speed: float = 1.0
+
+    def args(self) -> list[str]:
+        return ['-m', self.voice, '-fm', str(self.pitch), '-r', str(self.speed)]
+
+
+class SynthesisError(Exception):
+    pass
+
+
+def read_wav(data: bytes) -> tuple[bytes, int]:
+    """Return (16bit mono PCM, sample rate) from a WAV image"""
+    with wave.open(io.BytesIO(data), 'rb') as w:
+        if w.getsampwidth() != 2 or w.getnchannels() != 1:
+            raise SynthesisError("Unexpected WAV format from OpenJTalk")
+        return w.readframes(w.getnframes()), w.getframerate()
+
+
+async def kill_process(process: asyncio.subprocess.Process):
+    """Kill a child process and reap it without blocking the event loop"""
+    if process.returncode is not None:
+        return
+    try:
+        process.kill()
+    except ProcessLookupError:
+        return
+    try:
+        # キャンセル中でも回収まで待つ
+        await asyncio.shield(process.wait())
+    except asyncio.CancelledError:
+        pass
+
+
+class SynthesisEngine:
+    """Pool of long-lived OpenJTalk workers fed from a job queue"""
+
+    def __init__(self, workers: int | None = None, timeout: float = 30.0,
+                 processes: set | None = None, lock=None):
+        self.size = max(1, workers or os.cpu_count() or 1)
+        self.timeout = timeout
+        # app 側の active_processes と共有して終了時にまとめて止める
+        self.processes = processes if processes is not None else set()
+        self.lock = lock or threading.Lock()
+        # None: 未判定, True: 常駐ワーカー, False: 1回ずつ起動
+        self.persistent: bool | None = None
+        self.restarts = 0
+        self._jobs: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._closed = False
+
+    def start(self):
+        if self._tasks or self._closed:
+            return
+        self._jobs = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._run_worker(i)) for i in range(self.size)]
+        print(f"Synthesis engine started with {self.size} workers")
+
+    async def synthesize(self, text: str, params: VoiceParams = VoiceParams()) -> tuple[bytes, int]:
+        """Synthesize text and return (16bit mono PCM, sample rate)"""
+        if self._closed:
+            raise SynthesisError("Synthesis engine is closed")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._jobs.put((text, params, future))
+        return await future
+
+    def close(self):
+        """Stop accepting jobs and cancel the workers; processes are killed by the owner"""
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _run_worker(self, index: int):
+        process = None
+        try:
+            while True:
+                text, params, future = await self._jobs.get()
+                if future.done():
+                    continue
+                try:
+                    if self.persistent is not False and (process is None or process.returncode is not None):
+                        process = await self._spawn(index)
+                    if process is None:
+                        result = await self._oneshot(text, params)
+                    else:
+                        result = await asyncio.wait_for(self._request(process, text, params), self.timeout)
+                except asyncio.TimeoutError:
+                    if process is not None:
+                        self.restarts += 1
+                        await self._discard(process)
+                        process = None
+                    if not future.done():
+                        future.set_exception(SynthesisError("OpenJTalk timeout"))
+                except (BrokenPipeError, ConnectionResetError, asyncio.IncompleteReadError) as e:
+                    # ワーカーが落ちた場合は次のジョブで起動し直す
+                    print(f"Synthesis worker {index} crashed: {type(e).__name__}")
+                    if process is not None:
+                        self.restarts += 1
+                        await self._discard(process)
+                        process = None
+                    if not future.done():
+                        future.set_exception(SynthesisError("Synthesis worker crashed"))
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            if process is not None:
+                await self._discard(process)
+
+    async def _spawn(self, index: int) -> asyncio.subprocess.Process | None:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--worker',
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with self.lock:
+            self.processes.add(process)
+        try:
+            # 辞書と音響モデルの読み込み完了を待つ
+            status, _, payload = await asyncio.wait_for(self._read_response(process), self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            status, payload = STATUS_ERROR, b'worker did not start'
+        if status == STATUS_OK:
+            if self.persistent is None:
+                print("Synthesis workers are persistent (pyopenjtalk)")
+            self.persistent = True
+            return process
+        await self._discard(process)
+        if self.persistent is not True:
+            if self.persistent is None:
+                print(f"Persistent synthesis worker unavailable ({payload.decode(errors='replace')}), "
+                      "falling back to one open_jtalk process per message")
+            self.persistent = False
+            return None
+        raise SynthesisError(f"Failed to restart synthesis worker: {payload.decode(errors='replace')}")
+
+    async def _discard(self, process: asyncio.subprocess.Process):
+        await kill_process(process)
+        with self.lock:
+            self.processes.discard(process)
+
+    async def _request(self, process, text: str, params: VoiceParams) -> tuple[bytes, int]:
+        payload = json.dumps({
+            'text': text, 'voice': params.voice, 'pitch': params.pitch, 'speed': params.speed,
+        }).encode()
+        process.stdin.write(REQUEST_HEADER.pack(len(payload)) + payload)
+        await process.stdin.drain()
+        status, rate, data = await self._read_response(process)
+        if status != STATUS_OK:
+            raise SynthesisError(f"OpenJTalk failed: {data.decode(errors='replace')}")
+        return data, rate
+
+    @staticmethod
+    async def _read_response(process) -> tuple[int, int, bytes]:
+        status, rate, length = RESPONSE_HEADER.unpack(
+            await process.stdout.readexactly(RESPONSE_HEADER.size))
+        return status, rate, await process.stdout.readexactly(length)
+
+    async def _oneshot(self, text: str, params: VoiceParams) -> tuple[bytes, int]:
+        cmd = ['open_jtalk', '-x', DIC_DIR] + params.args() + ['-ow', '/dev/stdout']
+        c = await asyncio.create_subprocess_exec(
+            *cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self.lock:
+            self.processes.add(c)
+        try:
+            try:
+                stdout, stderr = await asyncio.wait_for(c.communicate(input=text.encode()), timeout=self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                # タイムアウト・キャンセル時は子プロセスを確実に止めて回収する
+                await kill_process(c)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise SynthesisError("OpenJTalk timeout") from e
+                raise
+            if c.returncode != 0:
+                raise SynthesisError(f"OpenJTalk failed: {stderr.decode(errors='replace')}")
+            return read_wav(stdout)
+        finally:
+            with self.lock:
+                self.processes.discard(c)
+
+
+def _write_response(out, status: int, rate: int, payload: bytes):
+    out.write(RESPONSE_HEADER.pack(status, rate, len(payload)) + payload)
+    out.flush()
+
+
+def worker_main():
+    """Persistent worker: keeps the MeCab dictionary and HTS voices loaded"""
+    # C ライブラリの出力でフレームが壊れないよう stdout を stderr に向け直す
+    out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    stdin = sys.stdin.buffer
+    try:
+        os.environ.setdefault('OPEN_JTALK_DICT_DIR', DIC_DIR)
+        import numpy as np
+        import pyopenjtalk
+        from pyopenjtalk.htsengine import HTSEngine
+        engines = {VOICE_PATH: HTSEngine(VOICE_PATH.encode())}
+        pyopenjtalk.extract_fullcontext('あ')
+    except Exception as e:
+        _write_response(out, STATUS_ERROR, 0, f"{type(e).__name__}: {e}".encode())
+        return
+    _write_response(out, STATUS_OK, 0, b'')
+
+    while True:
+        header = stdin.read(REQUEST_HEADER.size)
+        if len(header) < REQUEST_HEADER.size:
+            return
+        (length,) = REQUEST_HEADER.unpack(header)
+        try:
+            job = json.loads(stdin.read(length))
+            engine = engines.get(job['voice'])
+            if engine is None:
+                engine = engines[job['voice']] = HTSEngine(job['voice'].encode())
+            engine.set_speed(float(job['speed']))
+            engine.add_half_tone(float(job['pitch']))
+            labels = pyopenjtalk.extract_fullcontext(job['text'])
+            samples = engine.synthesize(labels)
+            engine.refresh()
+            pcm = np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+            _write_response(out, STATUS_OK, engine.get_sampling_frequency(), pcm)
+        except Exception as e:
+            _write_response(out, STATUS_ERROR, 0, f"{type(e).__name__}: {e}".encode())
+
+
+if __name__ == '__main__' and '--worker' in sys.argv:
+    worker_main()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Standalone synthesis service over a Unix or TCP socket.
+
+`python tts_service.py --listen unix:/run/tts.sock` (または `tcp:0.0.0.0:7700`) で
+合成サーバーを起動し、bot 側は TTS_SERVER に同じアドレスを指定すると
+RemoteSynthesisEngine 経由でここに合成を頼む。複数の bot プロセスで1つのサーバー
+(または負荷分散した複数のサーバー)を共有できる。
+
+1本の接続に複数のリクエストを続けて送ってよく、レスポンスは終わった順に
+リクエスト ID 付きで返る。処理中が上限に達した接続からは読み込みを止めるので、
+送りすぎたクライアントはソケットのバッファで待たされる。
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import struct
+
+from audio import make_clip
+from tts import SynthesisEngine, SynthesisError, VoiceParams
+
+# request:  >IfffBHI (id, pitch, speed, gain, encoding length, voice length, text length)
+#           + encoding + voice + text (UTF-8)
+# response: >IBII (id, status, sample rate, payload length) + payload
+REQUEST_HEADER = struct.Struct('>IfffBHI')
+RESPONSE_HEADER = struct.Struct('>IBII')
+STATUS_OK = 0
+STATUS_ERROR = 1
+# encoding にこれを指定すると、加工せずに合成結果の 16bit モノラル PCM を返す(gain も使わない)
+ENCODING_RAW = 'raw'
+
+
+def parse_address(address: str) -> tuple[str, str | tuple[str, int]]:
+    """'unix:/path' or 'tcp:host:port' -> (kind, address)"""
+    kind, _, rest = address.partition(':')
+    if kind == 'unix' and rest:
+        return kind, rest
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        if host and port.isdigit():
+            return kind, (host, int(port))
+    raise ValueError(f"Invalid synthesis server address: {address!r} (use unix:/path or tcp:host:port)")
+
+
+def pack_request(request_id: int, text: str, params: VoiceParams, encoding: str, gain: float = 1.0) -> bytes:
+    encoding_bytes, voice, body = encoding.encode(), params.voice.encode(), text.encode()
+    header = REQUEST_HEADER.pack(
+        request_id, params.pitch, params.speed, gain, len(encoding_bytes), len(voice), len(body))
+    return header + encoding_bytes + voice + body
+
+
+class SynthesisServer:
+    """Serve synthesis requests from a local SynthesisEngine"""
+
+    def __init__(self, engine: SynthesisEngine, max_inflight: int = 32, max_pending: int = 256):
+        self.engine = engine
+        # 1接続あたり・サーバー全体で同時に受け付けるリクエスト数
+        self.max_inflight = max_inflight
+        self._pending = asyncio.Semaphore(max_pending)
+        self.requests = 0
+        self.errors = 0
+
+    async def serve(self, address: str):
+        kind, target = parse_address(address)
+        if kind == 'unix':
+            if os.path.exists(target):
+                os.remove(target)
+            server = await asyncio.start_unix_server(self._handle, target)
+        else:
+            server = await asyncio.start_server(self._handle, *target)
+        self.engine.start()
+        print(f"Synthesis server listening on {address} with {self.engine.size} workers")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        inflight = asyncio.Semaphore(self.max_inflight)
+        tasks = set()
+        try:
+            while True:
+                # 処理中が上限ならソケットから読まない(クライアント側に詰まりが伝わる)
+                await inflight.acquire()
+                await self._pending.acquire()
+                try:
+                    header = await reader.readexactly(REQUEST_HEADER.size)
+                    request_id, pitch, speed, gain, encoding_length, voice_length, text_length = \
+                        REQUEST_HEADER.unpack(header)
+                    body = await reader.readexactly(encoding_length + voice_length + text_length)
+                    encoding = body[:encoding_length].decode()
+                    voice = body[encoding_length:encoding_length + voice_length].decode()
+                    text = body[encoding_length + voice_length:].decode()
+                    # float32 を通るので小数点以下を揃えてキャッシュのキーと合わせる
+                    params = VoiceParams(voice, round(pitch, 2), round(speed, 2))
+                except ValueError as e:
+                    # 中身が壊れていても長さは分かるので、エラーを返して次のリクエストを読む
+                    inflight.release()
+                    self._pending.release()
+                    self.errors += 1
+                    payload = f"Malformed request: {e}".encode()
+                    writer.write(RESPONSE_HEADER.pack(request_id, STATUS_ERROR, 0, len(payload)) + payload)
+                    continue
+                except BaseException:
+                    inflight.release()
+                    self._pending.release()
+                    raise
+                task = asyncio.create_task(self._respond(writer, request_id, text, params, encoding, round(gain, 2)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: (inflight.release(), self._pending.release()))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, request_id: int, text: str,
+                       params: VoiceParams, encoding: str, gain: float):
+        self.requests += 1
+        try:
+            pcm, rate = await self.engine.synthesize(text, params)
+            if encoding == ENCODING_RAW:
+                status, payload = STATUS_OK, pcm
+            else:
+                status, payload, rate = STATUS_OK, await asyncio.to_thread(make_clip, pcm, rate, encoding, gain), 0
+        except Exception as e:
+            self.errors += 1
+            status, rate, payload = STATUS_ERROR, 0, (str(e) or type(e).__name__).encode()
+        if writer.is_closing():
+            return
+        writer.write(RESPONSE_HEADER.pack(request_id, status, rate, len(payload)) + payload)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class _Connection:
+    __slots__ = ('reader', 'writer', 'pending', 'task')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pending: dict[int, asyncio.Future] = dict()
+        self.task: asyncio.Task | None = None
+
+    def alive(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+
+class RemoteSynthesisEngine:
+    """Client for SynthesisServer with a small pool of pipelined connections"""
+
+    def __init__(self, address: str, connections: int = 4, timeout: float = 30.0, max_inflight: int = 32):
+        self.address = address
+        self.kind, self.target = parse_address(address)
+        self.size = max(1, connections)
+        self.timeout = timeout
+        # 1接続あたりの送りっぱなしの上限。超えたら空くまで待つ
+        self.max_inflight = max_inflight
+        self.reconnects = 0
+        self._connections: list[_Connection | None] = [None] * self.size
+        self._connecting: list[asyncio.Task | None] = [None] * self.size
+        self._slots: asyncio.Semaphore | None = None
+        self._ids = itertools.count(1)
+        self._closed = False
+
+    def start(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size * self.max_inflight)
+
+    async def synthesize(self, text: str, params: VoiceParams = VoiceParams()) -> tuple[bytes, int]:
+        """Synthesize text and return (16bit mono PCM, sample rate)"""
+        return await self._call(text, params, ENCODING_RAW)
+
+    async def render(self, text: str, params: VoiceParams, encoding: str, gain: float = 1.0) -> bytes:
+        """Return a playable clip (see audio.make_clip) rendered by the server"""
+        clip, _ = await self._call(text, params, encoding, gain)
+        return clip
+
+    def close(self):
+        self._closed = True
+        for index, connection in enumerate(self._connections):
+            if connection is not None:
+                connection.task.cancel()
+                connection.writer.close()
+            self._connections[index] = None
+
+    async def _call(self, text: str, params: VoiceParams, encoding: str, gain: float = 1.0) -> tuple[bytes, int]:
+        if self._closed:
+            raise SynthesisError("Synthesis engine is closed")
+        self.start()
+        async with self._slots:
+            connection = await self._connection()
+            request_id = next(self._ids) & 0xFFFFFFFF
+            future = asyncio.get_running_loop().create_future()
+            connection.pending[request_id] = future
+            try:
+                connection.writer.write(pack_request(request_id, text, params, encoding, gain))
+                await connection.writer.drain()
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                raise SynthesisError("Synthesis server timeout") from None
+            except ConnectionError as e:
+                raise SynthesisError(f"Synthesis server connection lost: {e}") from None
+            finally:
+                connection.pending.pop(request_id, None)
+
+    async def _connection(self) -> _Connection:
+        # 処理中の少ない接続を使う。切れていたらつなぎ直す
+        index = min(range(self.size), key=lambda i: len(self._connections[i].pending)
+                    if self._connections[i] is not None and self._connections[i].alive() else -1)
+        connection = self._connections[index]
+        if connection is not None and connection.alive():
+            return connection
+        if self._connecting[index] is None or self._connecting[index].done():
+            self._connecting[index] = asyncio.create_task(self._connect(index))
+        return await asyncio.shield(self._connecting[index])
+
+    async def _connect(self, index: int) -> _Connection:
+        try:
+            if self.kind == 'unix':
+                reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.target), self.timeout)
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.target), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise SynthesisError(f"Cannot connect to synthesis server {self.address}: {e}") from None
+        if self._connections[index] is not None:
+            self.reconnects += 1
+        connection = _Connection(reader, writer)
+        connection.task = asyncio.create_task(self._read_responses(connection))
+        self._connections[index] = connection
+        return connection
+
+    async def _read_responses(self, connection: _Connection):
+        error = SynthesisError("Synthesis server closed the connection")
+        try:
+            while True:
+                header = await connection.reader.readexactly(RESPONSE_HEADER.size)
+                request_id, status, rate, length = RESPONSE_HEADER.unpack(header)
+                payload = await connection.reader.readexactly(length)
+                future = connection.pending.pop(request_id, None)
+                # タイムアウトした後に届いた結果は捨てる
+                if future is None or future.done():
+                    continue
+                if status == STATUS_OK:
+                    future.set_result((payload, rate))
+                else:
+                    future.set_exception(SynthesisError(payload.decode(errors='replace')))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f"Synthesis server connection lost: {type(e).__name__}")
+        finally:
+            connection.writer.close()
+            for future in connection.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+                    future.exception()
+            connection.pending.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the synthesis service')
+    parser.add_argument('--listen', default=os.environ.get('TTS_LISTEN', 'tcp:127.0.0.1:7700'),
+                        help='unix:/path or tcp:host:port')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('TTS_WORKERS', '0')))
+    parser.add_argument('--timeout', type=float, default=float(os.environ.get('JTALK_TIMEOUT', '30')))
+    parser.add_argument('--max-inflight', type=int, default=32, help='requests in flight per connection')
+    parser.add_argument('--max-pending', type=int, default=256, help='requests in flight in total')
+    args = parser.parse_args()
+
+    import discord
+    if not discord.opus.is_loaded():
+        # Opus で返すときだけ必要
+        try:
+            discord.opus.load_opus('libopus.so.0')
+        except Exception as e:
+            print(f"Opus library is not available, only PCM can be served: {e}")
+
+    processes = set()
+    engine = SynthesisEngine(args.workers or None, args.timeout, processes)
+    server = SynthesisServer(engine, args.max_inflight, args.max_pending)
+    try:
+        asyncio.run(server.serve(args.listen))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+        for process in list(processes):
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+
+
+if __name__ == '__main__':
+    main()